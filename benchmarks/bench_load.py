@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cold-load benchmark of the preprocessing side of a model
+directory: compares unpickling `preprocessor.p`, `pretrainer.p`,
+`known_lemmas.p` and `lemma_index.p` with loading the bundle
+(see `pandora.bundle`). Each load runs in a fresh interpreter,
+so that the time includes the imports it needs. Convert the
+model directory first if it has no bundle yet:
+
+    python -m pandora.bundle models/my_model
+    PYTHONPATH=. python benchmarks/bench_load.py models/my_model --repeats 5
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+PICKLES = ('preprocessor.p', 'pretrainer.p', 'known_lemmas.p', 'lemma_index.p')
+
+LOAD_PICKLES = """
+import os, pickle, sys
+for name in {pickles!r}:
+    path = os.path.join(sys.argv[1], name)
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            pickle.load(f)
+"""
+
+LOAD_BUNDLE = """
+import sys
+from pandora.bundle import load_bundle
+load_bundle(sys.argv[1])
+"""
+
+
+def size(paths):
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        for root, _, filenames in os.walk(path):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in filenames)
+    return total
+
+
+def timed_run(code, model_dir):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code, model_dir])
+    return time.time() - start
+
+
+def main(model_dir, repeats):
+    pickle_paths = [os.path.join(model_dir, name) for name in PICKLES]
+    bundle_path = os.path.join(model_dir, 'bundle')
+    runs = [('pickles', LOAD_PICKLES.format(pickles=PICKLES), pickle_paths),
+            ('bundle', LOAD_BUNDLE, [bundle_path])]
+
+    times = {}
+    for name, code, paths in runs:
+        if not any(os.path.exists(p) for p in paths):
+            print('No', name, 'in', model_dir, '- skipped')
+            continue
+        # best of several runs, in a fresh interpreter each time:
+        times[name] = min(timed_run(code, model_dir) for _ in range(repeats))
+        print('{:8s} {:8.1f} MB {:8.3f}s'.format(name, size(paths) / 1e6, times[name]))
+
+    if len(times) == 2:
+        print('speed-up: {:.1f}x'.format(times['pickles'] / max(times['bundle'], 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of model loading")
+    parser.add_argument("model_dir", help="Path to a model directory")
+    parser.add_argument("--repeats", type=int, default=3)
+    main(**vars(parser.parse_args()))
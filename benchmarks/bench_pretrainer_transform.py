@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for `Pretrainer.transform()`: compares the
+vectorized context-window construction with the former
+token-by-token implementation (kept below as reference),
+and checks that both produce identical output.
+
+    PYTHONPATH=. python benchmarks/bench_pretrainer_transform.py --nb_tokens 1000000
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import string
+import time
+
+import numpy as np
+
+from pandora.pretraining import Pretrainer
+
+
+def reference_transform(pretrainer, tokens):
+    """ Former implementation of `Pretrainer.transform()` """
+    context_ints = []
+    tokens = [t.lower() for t in tokens]
+    for curr_idx, token in enumerate(tokens):
+        ints = []
+        left_context_tokens = [tokens[curr_idx-(t+1)]\
+                                for t in range(pretrainer.nb_left_tokens)\
+                                    if curr_idx-(t+1) >= 0][::-1]
+        idxs = []
+        if left_context_tokens:
+            idxs = [pretrainer.token_idx[t] if t in pretrainer.token_idx else 0 \
+                        for t in left_context_tokens]
+        while len(idxs) < pretrainer.nb_left_tokens:
+            idxs = [0] + idxs
+        ints.extend(idxs)
+
+        right_context_tokens = [tokens[curr_idx+(t+1)]\
+                                    for t in range(pretrainer.nb_right_tokens)\
+                                        if curr_idx+(t+1) < len(tokens)]
+        idxs = []
+        if right_context_tokens:
+            idxs = [pretrainer.token_idx[t] if t in pretrainer.token_idx else 0 \
+                        for t in right_context_tokens]
+        while len(idxs) < pretrainer.nb_right_tokens:
+            idxs.append(0)
+        ints.extend(idxs)
+
+        context_ints.append(ints)
+
+    return np.asarray(context_ints, dtype='int32')
+
+
+def make_tokens(nb_tokens, nb_types, seed=42):
+    rnd = random.Random(seed)
+    types = [''.join(rnd.choice(string.ascii_letters) for _ in range(rnd.randint(1, 10)))
+             for _ in range(nb_types)]
+    # rough Zipfian sample:
+    weights = [1.0 / (rank + 1) for rank in range(nb_types)]
+    cum_weights = np.cumsum(weights)
+    picks = np.searchsorted(cum_weights, np.random.RandomState(seed).rand(nb_tokens) * cum_weights[-1])
+    return [types[i] for i in picks]
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main(nb_tokens, nb_types, nb_left_tokens, nb_right_tokens):
+    tokens = make_tokens(nb_tokens, nb_types)
+    pretrainer = Pretrainer(nb_left_tokens=nb_left_tokens,
+                            nb_right_tokens=nb_right_tokens)
+    # index half of the types only, so that unknown tokens occur:
+    pretrainer.token_idx = {'<UNK>': 0}
+    for t in sorted(set(t.lower() for t in tokens))[::2]:
+        pretrainer.token_idx[t] = len(pretrainer.token_idx)
+
+    old, old_time = timed(reference_transform, pretrainer, tokens)
+    new, new_time = timed(pretrainer.transform, tokens)
+    assert old.dtype == new.dtype and old.shape == new.shape and (old == new).all(), \
+        'Vectorized output differs from the reference implementation!'
+
+    print('Tokens:', nb_tokens, '- context:', nb_left_tokens, '+', nb_right_tokens)
+    print('reference:  {:.3f}s'.format(old_time))
+    print('vectorized: {:.3f}s'.format(new_time))
+    print('speed-up:   {:.1f}x'.format(old_time / max(new_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of Pretrainer.transform()")
+    parser.add_argument("--nb_tokens", type=int, default=200000)
+    parser.add_argument("--nb_types", type=int, default=20000)
+    parser.add_argument("--nb_left_tokens", type=int, default=2)
+    parser.add_argument("--nb_right_tokens", type=int, default=2)
+    main(**vars(parser.parse_args()))
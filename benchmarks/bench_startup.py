@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: time-to-first-token of a fresh process
+which loads a model through `pandora.inference` and annotates
+one sentence, broken down into imports, model loading and the
+first annotation. Also lists the training-only dependencies
+which were imported on the way (there should be none for a
+model in the bundle format).
+
+    PYTHONPATH=. python benchmarks/bench_startup.py models/12c_new --repeats 3
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+CHILD = """
+import json, sys, time
+start = time.time()
+from pandora.inference import load_tagger, loaded_training_modules
+imported = time.time()
+tagger = load_tagger(sys.argv[1])
+loaded = time.time()
+tagger.annotate(sys.argv[2].split())
+annotated = time.time()
+print(json.dumps({'import': imported - start,
+                  'load': loaded - imported,
+                  'first_annotation': annotated - loaded,
+                  'training_modules': loaded_training_modules()}))
+"""
+
+
+def run(model_dir, sentence):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', CHILD, model_dir, sentence])
+    total = time.time() - start
+    # the child prints progress while loading, the report comes last:
+    timings = json.loads(output.decode('utf8').strip().split('\n')[-1])
+    timings['total'] = total
+    return timings
+
+
+def main(model_dir, sentence, repeats):
+    runs = [run(model_dir, sentence) for _ in range(repeats)]
+    best = min(runs, key=lambda timings: timings['total'])
+    print('Best of', repeats, 'runs:')
+    for key in ('import', 'load', 'first_annotation'):
+        print('\t{:18s} {:.3f}s'.format(key, best[key]))
+    print('\t{:18s} {:.3f}s'.format('time-to-first-token', best['total']))
+    print('Training-only modules imported:', ', '.join(best['training_modules']) or 'none')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of tagger startup")
+    parser.add_argument("model_dir", help="Path to a model directory")
+    parser.add_argument("--sentence", default="Cur in theatrum , Cato severe , venisti ?")
+    parser.add_argument("--repeats", type=int, default=3)
+    main(**vars(parser.parse_args()))
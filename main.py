@@ -3,11 +3,15 @@
 
 from __future__ import print_function
 import argparse
+from functools import partial
+
 import pandora.utils
 from pandora.tagger import Tagger
+from pandora.cache import DatasetCache
 
 
-def main(config, train='data/wilhelmus/all_train', dev='data/wilhelmus/all_dev', **kwargs):
+def main(config, train='data/wilhelmus/all_train', dev='data/wilhelmus/all_dev',
+         resume=False, **kwargs):
     print('::: started :::')
     params = pandora.utils.get_param_dict(config)
     params['config_path'] = config
@@ -16,37 +20,65 @@ def main(config, train='data/wilhelmus/all_train', dev='data/wilhelmus/all_dev',
     for k, v in params.items():
         print("\t{} : {}".format(k, v))
 
-    train_data = pandora.utils.load_annotated_dir(
-        train,
-        format='tab',
-        extension='.tab',
-        include_pos=params['include_pos'],
-        include_lemma=params['include_lemma'],
-        include_morph=params['include_morph'],
-        nb_instances=None
-    )
-
-    dev_data = pandora.utils.load_annotated_dir(
-        dev,
-        format='tab',
-        extension='.tab',
-        include_pos=params['include_pos'],
-        include_lemma=params['include_lemma'],
-        include_morph=params['include_morph'],
-        nb_instances=None
-    )
-    
+    train_stream = None
+    if params.get('stream_train'):
+        # only keep the raw train data for fitting, vectorize per batch:
+        train_stream = partial(
+            pandora.utils.iter_annotated_dir,
+            train,
+            format='tab',
+            extension='.tab',
+            include_pos=params['include_pos'],
+            include_lemma=params['include_lemma'],
+            include_morph=params['include_morph']
+        )
+
+    load_annotated_dir = pandora.utils.load_annotated_dir
+    if params.get('dataset_cache') not in (None, '', 'None'):
+        # reuse corpora parsed by earlier runs:
+        load_annotated_dir = DatasetCache(params['dataset_cache']).load_annotated_dir
+
+    # only used to load the corpora, not a parameter of the tagger:
+    nb_load_workers = int(params.pop('nb_load_workers', 1))
+
     tagger = Tagger(**params)
-    tagger.setup_to_train(
-        train_data=train_data,
-        dev_data=dev_data
-    )
+    if resume:
+        # continue from the last checkpoint, on the saved dataset:
+        tagger.resume(train_stream=train_stream)
+    else:
+        train_data = load_annotated_dir(
+            train,
+            format='tab',
+            extension='.tab',
+            include_pos=params['include_pos'],
+            include_lemma=params['include_lemma'],
+            include_morph=params['include_morph'],
+            nb_instances=None,
+            nb_workers=nb_load_workers
+        )
+
+        dev_data = load_annotated_dir(
+            dev,
+            format='tab',
+            extension='.tab',
+            include_pos=params['include_pos'],
+            include_lemma=params['include_lemma'],
+            include_morph=params['include_morph'],
+            nb_instances=None,
+            nb_workers=nb_load_workers
+        )
+
+        tagger.setup_to_train(
+            train_data=train_data,
+            dev_data=dev_data,
+            train_stream=train_stream
+        )
     
-    for i in range(int(params['nb_epochs'])):
+    # the static artifacts are saved by setup_to_train(),
+    # each epoch saves a checkpoint of the weights:
+    for i in range(tagger.curr_nb_epochs, int(params['nb_epochs'])):
         tagger.epoch()
-        tagger.save()
 
-    tagger.save()
     print('::: ended :::')
 
 
@@ -56,5 +88,9 @@ if __name__ == '__main__':
     parser.add_argument("--dev", help="Path to directory containing dev files")
     parser.add_argument("--train", help="Path to directory containing train files")
     parser.add_argument("--nb_epochs", help="Number of epoch", type=int)
+    parser.add_argument("--nb_load_workers", type=int,
+                        help="Number of processes parsing the corpus files")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Resume an interrupted training run from its last checkpoint")
     main(**vars(parser.parse_args()))
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Length-bucketed batching for the recurrent focus encoder.
+The focus tokens are vectorized up to `max_token_len`, the
+length of the longest training token, so that each short
+token is otherwise run through the encoder for as many time
+steps as the longest one. With `nb_length_buckets`, the model
+accepts focus inputs of any length and masks the padding (see
+`build_model()`), and each batch is cut to the length of the
+longest token in it. Since the padding is masked, this yields
+the same results as processing the full-length inputs.
+
+The padding follows the (reversed) characters of each token
+(cf. `frame_token()`), so that cutting the trailing positions
+of a batch never drops any characters.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+def focus_lengths(X_focus):
+    """
+    Length of each focus token in a (one-hot or index) focus
+    tensor: the position after its last non-padding time step.
+    """
+    X_focus = np.asarray(X_focus)
+    if X_focus.ndim == 3:
+        filled = X_focus.any(axis=2)
+    else:
+        filled = X_focus > 0
+    max_len = filled.shape[1]
+    return np.where(filled.any(axis=1),
+                    max_len - np.argmax(filled[:, ::-1], axis=1), 0)
+
+
+def bucket_batches(lengths, batch_size, nb_buckets, shuffle=True):
+    """
+    Split the rows into batches (lists of row indices) whose
+    rows have similar lengths: the rows are assigned to one of
+    `nb_buckets` buckets by the quantiles of `lengths`, and
+    batches are cut from the rows ordered by bucket (in random
+    order within each bucket). The order of the batches is
+    shuffled as well.
+    """
+    nb_rows = len(lengths)
+    if shuffle:
+        order = np.random.permutation(nb_rows)
+    else:
+        order = np.arange(nb_rows)
+    if nb_rows:
+        edges = np.unique(np.percentile(lengths, np.linspace(0, 100, nb_buckets + 1)[1:-1]))
+        buckets = np.searchsorted(edges, np.asarray(lengths)[order], side='left')
+        order = order[np.argsort(buckets, kind='mergesort')]
+    batches = [order[i : i + batch_size] for i in range(0, nb_rows, batch_size)]
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+    return batches
+
+
+def cut_focus(inputs, idxs, lengths):
+    """
+    Select the rows `idxs` of a dict of model inputs, with the
+    focus input cut to the longest token among those rows.
+    """
+    selected = {k: v[idxs] for k, v in inputs.items()}
+    if 'focus_in' in selected:
+        max_len = max(int(np.max(lengths[idxs])) if len(idxs) else 0, 1)
+        selected['focus_in'] = selected['focus_in'][:, :max_len]
+    return selected
+
+
+def predict_bucketed(model, inputs, batch_size):
+    """
+    Bucketed alternative to `model.predict(inputs)`: the rows
+    are sorted by focus token length and predicted batch by
+    batch, each batch cut to its own longest token, after which
+    the predictions are put back in the original order.
+    """
+    lengths = focus_lengths(inputs['focus_in'])
+    order = np.argsort(lengths, kind='mergesort')
+    nb_rows = len(order)
+    outputs = None
+    for start in range(0, nb_rows, batch_size):
+        idxs = order[start : start + batch_size]
+        preds = model.predict(cut_focus(inputs, idxs, lengths),
+                              batch_size=batch_size)
+        if isinstance(preds, np.ndarray):
+            preds = [preds]
+        if outputs is None:
+            outputs = [np.zeros((nb_rows,) + p.shape[1:], dtype=p.dtype) for p in preds]
+        for output, p in zip(outputs, preds):
+            output[idxs] = p
+    if outputs is None:
+        # no rows at all:
+        return model.predict(inputs, batch_size=batch_size)
+    if len(outputs) == 1:
+        return outputs[0]
+    return outputs
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact on-disk format for everything a trained tagger needs
+next to its Keras architecture and weights: instead of pickling
+the whole `Preprocessor` and `Pretrainer` (with per-character
+numpy vectors, sklearn encoders, the gensim model and a copy of
+the training corpus), a bundle only holds the character
+vocabularies, the label arrays, the token vocabulary and the
+(sorted) known lemmas with their lemma index and lemma trie.
+
+A bundle is a directory `bundle/` inside the model directory,
+with a `meta.json` file for scalars and small vocabularies, and
+one `.npy` file per (larger) array, which are memory-mapped
+when loaded.
+
+Existing model directories can be converted with:
+
+    python -m pandora.bundle models/my_model
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+from pandora.preprocessing import Preprocessor, char_dicts, morph_index_matrix
+from pandora.pretraining import Pretrainer
+from pandora.postcorrection import BKTreeLemmaIndex, LinearLemmaIndex
+from pandora.decoding import LemmaTrie, build_lemma_trie
+
+BUNDLE_DIR = 'bundle'
+FORMAT_VERSION = 1
+
+PRETRAINER_PARAMS = ('nb_left_tokens', 'nb_right_tokens', 'size', 'nb_mfi',
+                     'window', 'minimum_count', 'nb_workers', 'nb_negative')
+PREPROCESSOR_PARAMS = ('max_token_len', 'focus_repr', 'focus_input', 'sparse_targets',
+                       'include_lemma', 'include_morph', 'max_lemma_len',
+                       'min_lem_cnt', 'nb_morph_cats')
+
+
+class LabelArray():
+    """
+    Stand-in for a fitted sklearn `LabelEncoder`, built from
+    its (sorted) classes, so that loading a model does not
+    need to import sklearn.
+    """
+
+    def __init__(self, classes):
+        self.classes_ = np.asarray(classes)
+
+    def transform(self, labels):
+        labels = np.asarray(labels, dtype=str)
+        idxs = np.searchsorted(self.classes_, labels)
+        found = idxs < len(self.classes_)
+        found[found] = self.classes_[idxs[found]] == labels[found]
+        if not found.all():
+            raise ValueError('y contains previously unseen labels')
+        return idxs
+
+    def inverse_transform(self, y):
+        return self.classes_[np.asarray(y, dtype='int64')]
+
+
+class FeatureArray():
+    """
+    Stand-in for a fitted (dense) sklearn `DictVectorizer`
+    over string-valued features, built from its feature names.
+    """
+
+    def __init__(self, feature_names, separator='='):
+        self.separator = separator
+        self.feature_names_ = list(feature_names)
+        self.vocabulary_ = {f: i for i, f in enumerate(self.feature_names_)}
+
+    def transform(self, dicts):
+        X = np.zeros((len(dicts), len(self.feature_names_)))
+        for i, d in enumerate(dicts):
+            for k, v in d.items():
+                idx = self.vocabulary_.get(k + self.separator + v)
+                if idx is not None:
+                    X[i, idx] = 1
+        return X
+
+
+def bundle_path(model_dir):
+    return os.sep.join((model_dir, BUNDLE_DIR))
+
+
+def has_bundle(model_dir):
+    return os.path.isfile(os.sep.join((bundle_path(model_dir), 'meta.json')))
+
+
+def _char_vocab(char_idx):
+    return [char_idx[i] for i in range(len(char_idx))]
+
+
+def _str_array(items):
+    return np.array([str(x) for x in items], dtype=str)
+
+
+def save_bundle(model_dir, preprocessor, pretrainer,
+                known_lemmas=None, lemma_index=None, lemma_trie=None):
+    """
+    Write a bundle for the given (fitted) objects. The bundle is
+    assembled under a temporary name and then moved in place, so
+    that a bundle is never left half-written.
+    """
+    meta = {'format_version': FORMAT_VERSION}
+    arrays = {}
+
+    # preprocessor:
+    prep = {k: getattr(preprocessor, k) for k in PREPROCESSOR_PARAMS \
+                if hasattr(preprocessor, k)}
+    prep['token_chars'] = _char_vocab(preprocessor.token_char_idx)
+    if hasattr(preprocessor, 'lemma_char_idx'):
+        prep['lemma_chars'] = _char_vocab(preprocessor.lemma_char_idx)
+    arrays['known_tokens'] = _str_array(sorted(preprocessor.known_tokens))
+    if hasattr(preprocessor, 'known_lemmas'):
+        arrays['train_lemmas'] = _str_array(sorted(preprocessor.known_lemmas))
+    if hasattr(preprocessor, 'lemma_encoder'):
+        arrays['lemma_classes'] = _str_array(preprocessor.lemma_encoder.classes_)
+    if hasattr(preprocessor, 'pos_encoder'):
+        arrays['pos_classes'] = _str_array(preprocessor.pos_encoder.classes_)
+    if getattr(preprocessor, 'include_morph', None) == 'label':
+        arrays['morph_classes'] = _str_array(preprocessor.morph_encoder.classes_)
+    elif getattr(preprocessor, 'include_morph', None) == 'multilabel':
+        arrays['morph_features'] = _str_array(preprocessor.morph_encoder.feature_names_)
+        # keep the order of the categories (cf. `morph_index_matrix()`):
+        prep['morph_idxs'] = [[label, sorted(idxs)] \
+                                for label, idxs in preprocessor.morph_idxs.items()]
+    meta['preprocessor'] = prep
+
+    # pretrainer (the embeddings themselves live in the model weights):
+    pretr = {k: getattr(pretrainer, k) for k in PRETRAINER_PARAMS \
+                if hasattr(pretrainer, k)}
+    pretr['mfi'] = list(getattr(pretrainer, 'mfi', []))
+    meta['pretrainer'] = pretr
+    arrays['token_vocab'] = _str_array(pretrainer.train_token_vocab)
+
+    # known lemmas and index for post-correction:
+    if known_lemmas is not None:
+        arrays['known_lemmas'] = _str_array(sorted(known_lemmas))
+    if isinstance(lemma_index, BKTreeLemmaIndex):
+        words, parents, edges = lemma_index.to_arrays()
+        meta['lemma_index'] = 'bktree'
+        arrays['lemma_index_words'] = _str_array(words)
+        arrays['lemma_index_parents'] = np.asarray(parents, dtype='int32')
+        arrays['lemma_index_edges'] = np.asarray(edges, dtype='int32')
+    elif isinstance(lemma_index, LinearLemmaIndex):
+        meta['lemma_index'] = 'linear'
+        arrays['lemma_index_words'] = _str_array(lemma_index.lemmas)
+
+    # trie for beam search decoding:
+    if lemma_trie is not None:
+        lemmas, parents, chars, ends = lemma_trie.to_arrays()
+        meta['lemma_trie'] = True
+        arrays['lemma_trie_lemmas'] = _str_array(lemmas)
+        arrays['lemma_trie_parents'] = np.asarray(parents, dtype='int32')
+        arrays['lemma_trie_chars'] = np.asarray(chars, dtype='int32')
+        arrays['lemma_trie_ends'] = np.asarray(ends, dtype='int32')
+
+    # the lemma lists usually coincide, only store them once:
+    meta['aliases'] = {}
+    for name in ('train_lemmas', 'lemma_index_words', 'lemma_trie_lemmas'):
+        if name in arrays and 'known_lemmas' in arrays and \
+                np.array_equal(arrays[name], arrays['known_lemmas']):
+            del arrays[name]
+            meta['aliases'][name] = 'known_lemmas'
+
+    final_path = bundle_path(model_dir)
+    tmp_path = final_path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.sep.join((tmp_path, name + '.npy')), array, allow_pickle=False)
+    with open(os.sep.join((tmp_path, 'meta.json')), 'w') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    if os.path.isdir(final_path):
+        shutil.rmtree(final_path)
+    os.rename(tmp_path, final_path)
+
+
+def load_bundle(model_dir, mmap_mode='r'):
+    """
+    Load a bundle and return a dict with the `preprocessor`,
+    the `pretrainer`, the `known_lemmas` (a set, or None),
+    the `known_lemma_index` and the `lemma_trie` (or None).
+    """
+    path = bundle_path(model_dir)
+    with open(os.sep.join((path, 'meta.json'))) as f:
+        meta = json.load(f)
+    if meta.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError('Model bundle in ' + path + ' was written by a newer version.')
+
+    def array(name):
+        name = meta.get('aliases', {}).get(name, name)
+        filepath = os.sep.join((path, name + '.npy'))
+        if os.path.isfile(filepath):
+            return np.load(filepath, mmap_mode=mmap_mode, allow_pickle=False)
+        return None
+
+    # preprocessor:
+    prep = meta['preprocessor']
+    preprocessor = Preprocessor()
+    for k in PREPROCESSOR_PARAMS:
+        if k in prep:
+            setattr(preprocessor, k, prep[k])
+    preprocessor.token_char_dict, preprocessor.token_char_idx = \
+        char_dicts(prep['token_chars'])
+    if 'lemma_chars' in prep:
+        preprocessor.lemma_char_dict, preprocessor.lemma_char_idx = \
+            char_dicts(prep['lemma_chars'])
+    sets = {}
+    def as_set(name):
+        # aliased arrays share the same set:
+        name = meta.get('aliases', {}).get(name, name)
+        if name not in sets:
+            items = array(name)
+            sets[name] = None if items is None else set(items.tolist())
+        return sets[name]
+
+    preprocessor.known_tokens = as_set('known_tokens')
+    if array('train_lemmas') is not None:
+        preprocessor.known_lemmas = as_set('train_lemmas')
+
+    for attr, name in (('lemma_encoder', 'lemma_classes'),
+                       ('pos_encoder', 'pos_classes'),
+                       ('morph_encoder', 'morph_classes')):
+        classes = array(name)
+        if classes is not None:
+            setattr(preprocessor, attr, LabelArray(classes))
+    features = array('morph_features')
+    if features is not None:
+        encoder = FeatureArray(features.tolist())
+        preprocessor.morph_encoder = encoder
+        preprocessor.morph_idxs = {label: set(idxs) for label, idxs in prep['morph_idxs']}
+        preprocessor.morph_idx_matrix = morph_index_matrix(preprocessor.morph_idxs)
+
+    # pretrainer:
+    pretr = meta['pretrainer']
+    pretrainer = Pretrainer(**{k: pretr[k] for k in PRETRAINER_PARAMS if k in pretr})
+    pretrainer.mfi = pretr.get('mfi', [])
+    pretrainer.train_token_vocab = array('token_vocab').tolist()
+    pretrainer.token_idx = {t: i for i, t in enumerate(pretrainer.train_token_vocab)}
+
+    # known lemmas and lemma index:
+    known_lemmas = as_set('known_lemmas')
+    lemma_index = None
+    if meta.get('lemma_index') == 'bktree':
+        lemma_index = BKTreeLemmaIndex.from_arrays(array('lemma_index_words').tolist(),
+                                                   array('lemma_index_parents'),
+                                                   array('lemma_index_edges'))
+    elif meta.get('lemma_index') == 'linear':
+        lemma_index = LinearLemmaIndex([])
+        lemma_index.lemmas = array('lemma_index_words').tolist()
+    lemma_trie = None
+    if meta.get('lemma_trie'):
+        lemma_trie = LemmaTrie.from_arrays(array('lemma_trie_lemmas').tolist(),
+                                           array('lemma_trie_parents'),
+                                           array('lemma_trie_chars'),
+                                           array('lemma_trie_ends'))
+
+    return {'preprocessor': preprocessor,
+            'pretrainer': pretrainer,
+            'known_lemmas': known_lemmas,
+            'known_lemma_index': lemma_index,
+            'lemma_trie': lemma_trie}
+
+
+def convert(model_dir):
+    """
+    Write a bundle for a model directory which only holds the
+    pickled preprocessor, pretrainer, known lemmas (and lemma
+    index). The pickles are left in place. For lemma generators,
+    the lemma trie is built as well.
+    """
+    def unpickle(name):
+        filepath = os.sep.join((model_dir, name))
+        if os.path.isfile(filepath):
+            with open(filepath, 'rb') as f:
+                return pickle.load(f)
+        return None
+
+    preprocessor = unpickle('preprocessor.p')
+    known_lemmas = unpickle('known_lemmas.p')
+    lemma_trie = None
+    if known_lemmas is not None and getattr(preprocessor, 'include_lemma', None) == 'generate':
+        lemma_trie = build_lemma_trie(known_lemmas, preprocessor)
+    save_bundle(model_dir,
+                preprocessor=preprocessor,
+                pretrainer=unpickle('pretrainer.p'),
+                known_lemmas=known_lemmas,
+                lemma_index=unpickle('lemma_index.p'),
+                lemma_trie=lemma_trie)
+
+
+def _size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, filename)) \
+                for root, _, filenames in os.walk(path) for filename in filenames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert model directories to the bundle format")
+    parser.add_argument("model_dirs", nargs='+', help="Path(s) to model directories")
+    args = parser.parse_args()
+
+    for model_dir in args.model_dirs:
+        print('Converting', model_dir, '...')
+        convert(model_dir)
+        pickled = sum(_size(os.sep.join((model_dir, name))) for name in \
+                        ('preprocessor.p', 'pretrainer.p', 'known_lemmas.p', 'lemma_index.p') \
+                        if os.path.isfile(os.sep.join((model_dir, name))))
+        print('\t pickles: {:.1f} MB - bundle: {:.1f} MB'.format(
+            pickled / 1e6, _size(bundle_path(model_dir)) / 1e6))
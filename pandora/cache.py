@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache for the steps which precede model
+building: parsing the corpora, fitting the preprocessor and
+pretraining embeddings, and vectorizing the data. Each entry
+is a folder named after a fingerprint (a hash) of everything
+which determines its content: the contents of the input files
+or data, and the parameters which the step depends on. Runs
+which only differ in other parameters (e.g. `nb_dense_dims`
+or `dropout_level`) thus reuse the entries of earlier runs.
+
+Arrays are stored as .npy files (memory-mapped when loaded),
+other objects are pickled.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+import pandora.utils as utils
+
+
+def fingerprint(*parts):
+    """ Hash of any JSON-serializable parts (e.g. parameters and other hashes). """
+    encoded = json.dumps(parts, sort_keys=True, default=str).encode('utf8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def file_fingerprint(directory, extension):
+    """
+    Hash of the relative paths and contents of the files
+    under `directory` which end with `extension`.
+    """
+    h = hashlib.sha1()
+    for filepath in sorted(utils.annotated_files(directory, extension)):
+        h.update(os.path.relpath(filepath, directory).encode('utf8') + b'\0')
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def data_fingerprint(data):
+    """
+    Hash of a dict of (string) columns, such as returned by
+    `utils.load_annotated_dir()`.
+    """
+    h = hashlib.sha1()
+    for key in sorted(data):
+        if data[key] is None:
+            continue
+        h.update(key.encode('utf8') + b'\0')
+        h.update('\n'.join(data[key]).encode('utf8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class DatasetCache():
+
+    def __init__(self, cache_dir='.pandora_cache'):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def entry_path(self, key):
+        return os.sep.join((self.cache_dir, key))
+
+    def has(self, key):
+        return os.path.isdir(self.entry_path(key))
+
+    def load(self, key, mmap_mode='r'):
+        """
+        Return a dict with the items stored under `key`,
+        or None if there is no such entry.
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        items = {}
+        for filename in os.listdir(path):
+            name, ext = os.path.splitext(filename)
+            filepath = os.sep.join((path, filename))
+            if ext == '.npy':
+                items[name] = np.load(filepath, mmap_mode=mmap_mode, allow_pickle=False)
+            elif ext == '.p':
+                with open(filepath, 'rb') as f:
+                    items[name] = pickle.load(f)
+        return items
+
+    def save(self, key, items):
+        """
+        Store a dict of items under `key`: numpy arrays as .npy
+        files, anything else pickled. The entry is written under
+        a temporary name and renamed once complete; if another
+        run stored the same entry in the meantime, it is kept.
+        """
+        path = self.entry_path(key)
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, value in items.items():
+            if isinstance(value, np.ndarray):
+                np.save(os.sep.join((tmp_path, name + '.npy')), value, allow_pickle=False)
+            else:
+                with open(os.sep.join((tmp_path, name + '.p')), 'wb') as f:
+                    pickle.dump(value, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # stored concurrently by another run:
+            shutil.rmtree(tmp_path)
+
+    def load_annotated_dir(self, directory, format='tab', extension='.txt', nb_instances=None,
+                           include_lemma=True, include_morph=True, include_pos=True,
+                           nb_workers=1):
+        """
+        Cached version of `utils.load_annotated_dir()`.
+        """
+        params = {'format': format, 'extension': extension, 'nb_instances': nb_instances,
+                  'include_lemma': include_lemma, 'include_morph': include_morph,
+                  'include_pos': include_pos}
+        key = fingerprint('corpus', file_fingerprint(directory, extension), params)
+        cached = self.load(key)
+        if cached is not None:
+            print('Loading', directory, 'from cache', key[:10], '...')
+            return {k: v.tolist() for k, v in cached.items()}
+
+        instances = utils.load_annotated_dir(directory, nb_workers=nb_workers, **params)
+        self.save(key, {k: np.array(v, dtype=str) for k, v in instances.items()})
+        return instances
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Columnar representation of an annotated corpus, in which each
+column (tokens, lemmas, pos tags, morph analyses) is interned
+once: an int32 array of ids into a vocabulary of the distinct
+strings. Fitting the preprocessor and the pretrainer, and the
+evaluation, work on the vocabulary and the ids, so that each
+distinct string is only hashed, lowercased, counted or looked
+up once, instead of once per occurrence in every stage.
+
+Columns behave like (read-only) lists of strings where the
+rest of the code expects those, and the functions which
+accept a column also accept a plain list (see `as_column()`).
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+class Column():
+    """
+    A column of strings, stored as `ids` (an int32 array) into
+    `vocab` (the distinct strings, in order of first occurrence).
+    """
+
+    def __init__(self, items=None, ids=None, vocab=None):
+        if items is not None:
+            index = {}
+            ids = np.fromiter((index.setdefault(item, len(index)) for item in items),
+                              dtype='int32')
+            vocab = list(index)
+        self.ids = ids
+        self.vocab = vocab
+        self._counts = None
+        self._lower = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.vocab[self.ids[idx]]
+        # slices and index arrays yield plain lists:
+        return [self.vocab[i] for i in self.ids[idx]]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.vocab, dtype=dtype or str)[self.ids]
+
+    def tolist(self):
+        return np.array(self.vocab, dtype=object)[self.ids].tolist()
+
+    @property
+    def counts(self):
+        """ Frequency of each vocabulary item (cached). """
+        if self._counts is None:
+            self._counts = np.bincount(self.ids, minlength=len(self.vocab))
+        return self._counts
+
+    def most_common(self, n=None):
+        """
+        The `n` most frequent items, in the same order as
+        `collections.Counter.most_common()` (ties are kept in
+        order of first occurrence).
+        """
+        order = np.argsort(-self.counts, kind='mergesort')[:n]
+        return [self.vocab[i] for i in order]
+
+    def lower(self):
+        """ Lowercased version of the column (cached). """
+        if self._lower is None:
+            index = {}
+            remap = np.fromiter((index.setdefault(item.lower(), len(index)) \
+                                    for item in self.vocab),
+                                dtype='int32', count=len(self.vocab))
+            self._lower = Column(ids=remap[self.ids], vocab=list(index))
+            # lowercasing is idempotent:
+            self._lower._lower = self._lower
+        return self._lower
+
+    def isin(self, items):
+        """
+        Boolean mask which tells, for each item of the column,
+        whether it is in `items` (e.g. a set of known tokens).
+        """
+        known = np.array([item in items for item in self.vocab], dtype=bool)
+        return known[self.ids]
+
+    def map_types(self, func):
+        """
+        Apply `func`, which maps a list of strings to an array
+        with one row per string (e.g. `vectorize_tokens()`), to
+        the vocabulary only, and return the result with one row
+        per item of the column.
+        """
+        return np.asarray(func(self.vocab))[self.ids]
+
+
+def as_column(items):
+    """ Intern a list of strings, unless it is a column already. """
+    if isinstance(items, Column):
+        return items
+    return Column(items)
+
+
+class Corpus():
+    """
+    Interned columns of a dict of annotated instances, such as
+    returned by `utils.load_annotated_dir()` (columns which are
+    None stay None).
+    """
+
+    def __init__(self, data):
+        self.columns = {k: None if v is None else as_column(v) \
+                            for k, v in data.items()}
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def get(self, key, default=None):
+        return self.columns.get(key, default)
+
+    def keys(self):
+        return self.columns.keys()
+
+    def __len__(self):
+        return len(self.columns['token'])
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Beam search decoding of the lemma generator's outputs over a
+trie of the known lemmas. The decoder emits a distribution
+over the characters of each position of the framed lemma
+('%' + lemma + '|', padded with '$', cf. `frame_lemma()`),
+independently per position. The score of a lemma is thus the
+sum of the log-probabilities of its characters, and a beam
+search which only follows the branches of the trie yields the
+best-scoring known lemma, so that these lemmas do not need
+post-correction. Optionally, the greedy (unconstrained) output
+is kept instead when its probability reaches a threshold, to
+allow novel lemmas.
+
+The search runs for all tokens at once, position by position.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from pandora.preprocessing import decode_sequences
+
+# log-probabilities are floored to keep scores finite:
+EPSILON = 1e-12
+
+
+class LemmaTrie():
+    """
+    Trie over the (lowercased, truncated) known lemmas, in the
+    character indices of the lemma decoder. Nodes are stored
+    as flat arrays: the parent and the character of each node,
+    and, for nodes where a lemma ends, the index of that lemma
+    in `lemmas` (-1 elsewhere). Node 0 is the root.
+    """
+
+    def __init__(self, lemmas, char_idx_dict, max_len):
+        self.lemmas = sorted(set(lemmas))
+        parents, chars, ends = [-1], [-1], [-1]
+        children = [{}]
+        for i, lemma in enumerate(self.lemmas):
+            # same framing as `frame_lemma()`:
+            seq = lemma.lower()[:(max_len - 2)]
+            if any(char not in char_idx_dict for char in seq):
+                continue
+            node = 0
+            for char in seq:
+                char = char_idx_dict[char]
+                child = children[node].get(char)
+                if child is None:
+                    child = children[node][char] = len(parents)
+                    parents.append(node)
+                    chars.append(char)
+                    ends.append(-1)
+                    children.append({})
+                node = child
+            # lemmas which only differ in case or beyond max_len
+            # end in the same node, the first one (sorted) wins:
+            if ends[node] < 0:
+                ends[node] = i
+        self._set_arrays(parents, chars, ends)
+
+    def _set_arrays(self, parents, chars, ends):
+        self.parents = np.asarray(parents, dtype='int32')
+        self.chars = np.asarray(chars, dtype='int32')
+        self.ends = np.asarray(ends, dtype='int32')
+        # children of each node, contiguous (CSR layout):
+        nb_children = np.bincount(self.parents[1:], minlength=len(self.parents))
+        self.child_ptr = np.concatenate(([0], np.cumsum(nb_children))).astype('int64')
+        self.child_nodes = (np.argsort(self.parents[1:], kind='mergesort') + 1).astype('int32')
+
+    def __len__(self):
+        return len(self.parents)
+
+    def to_arrays(self):
+        return self.lemmas, self.parents, self.chars, self.ends
+
+    @classmethod
+    def from_arrays(cls, lemmas, parents, chars, ends):
+        """ Inverse of `to_arrays()`. """
+        trie = cls([], {}, 0)
+        trie.lemmas = list(lemmas)
+        trie._set_arrays(parents, chars, ends)
+        return trie
+
+    def search(self, logprobs, start_idx, end_idx, pad_idx, beam_width=5):
+        """
+        Beam search for the best-scoring known lemma of each row
+        of an (nb_rows, max_len, nb_chars) tensor of character
+        log-probabilities. Returns the indices of the lemmas in
+        `lemmas` (-1 where none was found) and their scores.
+        """
+        nb_rows, max_len, _ = logprobs.shape
+        rows = np.arange(nb_rows)
+        # score of the '$' padding from each position onwards:
+        pad_scores = np.zeros((nb_rows, max_len + 1), dtype=logprobs.dtype)
+        pad_scores[:, :max_len] = np.cumsum(logprobs[:, ::-1, pad_idx], axis=1)[:, ::-1]
+
+        best_scores = np.full(nb_rows, -np.inf)
+        best_nodes = np.full(nb_rows, -1, dtype='int64')
+        beam_nodes = np.zeros((nb_rows, 1), dtype='int64')
+        beam_scores = logprobs[:, 0, start_idx][:, np.newaxis].astype('float64')
+
+        # the beam holds nodes at `depth`, whose next char comes
+        # at position depth + 1 (position 0 holds the '%'):
+        for depth in range(max_len - 1):
+            valid = beam_nodes >= 0
+            safe_nodes = np.where(valid, beam_nodes, 0)
+
+            # complete the lemmas which end here:
+            ends = valid & (self.ends[safe_nodes] >= 0)
+            end_scores = beam_scores + (logprobs[:, depth + 1, end_idx] + \
+                                        pad_scores[:, depth + 2])[:, np.newaxis]
+            end_scores = np.where(ends, end_scores, -np.inf)
+            best_col = np.argmax(end_scores, axis=1)
+            candidate_scores = end_scores[rows, best_col]
+            improved = candidate_scores > best_scores
+            best_scores[improved] = candidate_scores[improved]
+            best_nodes[improved] = safe_nodes[rows, best_col][improved]
+
+            if depth + 1 > max_len - 2:
+                break
+
+            # expand all beams by their children:
+            beam_rows, beam_cols = np.nonzero(valid)
+            nodes = beam_nodes[beam_rows, beam_cols]
+            starts = self.child_ptr[nodes]
+            counts = self.child_ptr[nodes + 1] - starts
+            total = int(counts.sum())
+            if not total:
+                break
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            kids = self.child_nodes[np.repeat(starts, counts) + offsets]
+            cand_rows = np.repeat(beam_rows, counts)
+            cand_scores = np.repeat(beam_scores[beam_rows, beam_cols], counts) + \
+                            logprobs[cand_rows, depth + 1, self.chars[kids]]
+
+            # scores only decrease further on, so candidates which
+            # can't beat a completed lemma are dropped:
+            keep = cand_scores > best_scores[cand_rows]
+            cand_rows, cand_scores, kids = cand_rows[keep], cand_scores[keep], kids[keep]
+            if not len(kids):
+                break
+
+            # keep the `beam_width` best candidates of each row:
+            order = np.lexsort((-cand_scores, cand_rows))
+            cand_rows, cand_scores, kids = cand_rows[order], cand_scores[order], kids[order]
+            group_starts = np.searchsorted(cand_rows, cand_rows, side='left')
+            ranks = np.arange(len(cand_rows)) - group_starts
+            selected = ranks < beam_width
+            beam_nodes = np.full((nb_rows, beam_width), -1, dtype='int64')
+            beam_scores = np.full((nb_rows, beam_width), -np.inf)
+            beam_nodes[cand_rows[selected], ranks[selected]] = kids[selected]
+            beam_scores[cand_rows[selected], ranks[selected]] = cand_scores[selected]
+
+        lemma_idxs = np.where(best_nodes >= 0, self.ends[np.maximum(best_nodes, 0)], -1)
+        return lemma_idxs, best_scores
+
+    def decode(self, predictions, char_idx, beam_width=5, novel_lemma_threshold=None):
+        """
+        Decode the lemma generator's `predictions` into known
+        lemmas. Where no known lemma is found, or where the
+        greedy output has a probability of at least
+        `novel_lemma_threshold` (if given), the greedy output
+        is returned instead.
+        """
+        predictions = np.asarray(predictions)
+        greedy_ids = np.argmax(predictions, axis=2)
+        lemmas = decode_sequences(greedy_ids, char_idx)
+        if not len(predictions):
+            return lemmas
+
+        char_idx_dict = char_index_from_idx(char_idx)
+        logprobs = np.log(np.maximum(predictions, EPSILON))
+        lemma_idxs, _ = self.search(logprobs,
+                                    start_idx=char_idx_dict['%'],
+                                    end_idx=char_idx_dict['|'],
+                                    pad_idx=char_idx_dict['$'],
+                                    beam_width=beam_width)
+        use_known = lemma_idxs >= 0
+        if novel_lemma_threshold is not None:
+            greedy_probs = np.exp(np.max(logprobs, axis=2).sum(axis=1))
+            use_known &= greedy_probs < novel_lemma_threshold
+        for i in np.nonzero(use_known)[0]:
+            lemmas[i] = self.lemmas[lemma_idxs[i]]
+        return lemmas
+
+
+def char_index_from_idx(char_idx):
+    """ Map each char of an index -> char dict to its index. """
+    return {char: idx for idx, char in char_idx.items()}
+
+
+def build_lemma_trie(lemmas, preprocessor):
+    """ Trie of `lemmas` for the lemma generator of `preprocessor`. """
+    return LemmaTrie(lemmas, char_index_from_idx(preprocessor.lemma_char_idx),
+                     preprocessor.max_lemma_len)
@@ -7,6 +7,8 @@ from collections import Counter
 from operator import itemgetter
 import numpy as np
 
+from pandora.corpus import as_column
+
 def single_label_accuracies(gold, silver, test_tokens, known_tokens,
                             print_scores=True):
     """
@@ -16,9 +18,11 @@ def single_label_accuracies(gold, silver, test_tokens, known_tokens,
     kno_corr, unk_corr = 0.0, 0.0
     nb_kno, nb_unk = 0.0, 0.0
 
-    for gold_pred, silver_pred, tok in zip(gold, silver, test_tokens):
+    # look up each distinct token once:
+    known = as_column(test_tokens).isin(known_tokens)
+    for gold_pred, silver_pred, is_known in zip(gold, silver, known):
 
-        if tok in known_tokens:
+        if is_known:
             nb_kno += 1
             if gold_pred == silver_pred:
                 kno_corr += 1
@@ -51,10 +55,12 @@ def multilabel_accuracies(gold, silver, test_tokens, known_tokens,
     kno_corr, unk_corr = 0.0, 0.0
     nb_kno, nb_unk = 0.0, 0.0
 
-    for gold_pred, silver_pred, tok in zip(gold, silver, test_tokens):
+    # look up each distinct token once:
+    known = as_column(test_tokens).isin(known_tokens)
+    for gold_pred, silver_pred, is_known in zip(gold, silver, known):
         gold_pred = set(gold_pred.split('|'))
         silver_pred = set(silver_pred.split('|'))
-        if tok in known_tokens:
+        if is_known:
             nb_kno += 1
             if gold_pred == silver_pred:
                 kno_corr += 1
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Inference-only entry point: loads a saved model and annotates
+with it, without importing the dependencies which are only
+needed for training or plotting (gensim, sklearn, matplotlib,
+seaborn). This holds for model directories in the bundle
+format (see `pandora.bundle`): the pickles of older models
+need sklearn and gensim to be unpickled.
+
+    from pandora.inference import load_tagger
+    tagger = load_tagger('models/12c_new')
+    tagger.annotate(['Cur', 'in', 'theatrum'])
+"""
+
+from __future__ import print_function
+
+import sys
+
+from pandora.tagger import Tagger
+
+TRAINING_MODULES = ('gensim', 'sklearn', 'matplotlib', 'seaborn')
+
+
+def load_tagger(model_dir, **overwrite):
+    """
+    Load the tagger saved in `model_dir`; keyword arguments
+    overwrite parameters of its configuration file.
+    """
+    return Tagger(load=True, model_dir=model_dir,
+                  overwrite={k: v for k, v in overwrite.items() if v is not None})
+
+
+def loaded_training_modules():
+    """ Training-only dependencies imported so far. """
+    return [name for name in TRAINING_MODULES if name in sys.modules]
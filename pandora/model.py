@@ -9,6 +9,7 @@ from keras.layers.embeddings import Embedding
 from keras.optimizers import Adam
 from keras.objectives import categorical_crossentropy
 from keras.optimizers import Adam, RMSprop
+import numpy as np
 
 def build_model(token_len, token_char_vector_dict,
                 nb_encoding_layers, nb_dense_dims,
@@ -27,22 +28,62 @@ def build_model(token_len, token_char_vector_dict,
                 filter_length = 3,
                 focus_repr = 'recurrent',
                 dropout_level = .15,
+                focus_input = 'onehot',
+                nb_char_embedding_dims = 50,
+                sparse_targets = False,
+                bucket_lengths = False,
                 ):
     
     inputs, outputs = [], []
     subnets = []
     
     if include_token:
+        nb_chars = len(token_char_vector_dict)
+        if bucket_lengths:
+            if focus_repr != 'recurrent':
+                raise ValueError('Length buckets (`nb_length_buckets`) need a recurrent `focus_repr`.')
+            # focus tokens of any length, with masked padding
+            # (see `pandora.bucketing`):
+            token_len = None
         # add input layer:
-        token_input = Input(shape=(token_len, len(token_char_vector_dict)),
-                            name='focus_in')
+        if focus_input == 'onehot':
+            token_input = Input(shape=(token_len, nb_chars),
+                                name='focus_in')
+            focus_chars = token_input
+            if bucket_lengths:
+                focus_chars = Masking(mask_value=0.,
+                                      name='focus_mask')(focus_chars)
+        else:
+            # char indices (0 = padding/unknown char):
+            token_input = Input(shape=(token_len,), dtype='int32',
+                                name='focus_in')
+            if focus_input == 'lookup':
+                # fixed one-hot lookup, equivalent to the onehot input:
+                lookup = np.vstack((np.zeros((1, nb_chars), dtype='float32'),
+                                    np.eye(nb_chars, dtype='float32')))
+                focus_chars = Embedding(input_dim=nb_chars + 1,
+                                        output_dim=nb_chars,
+                                        weights=[lookup],
+                                        trainable=False,
+                                        mask_zero=bucket_lengths,
+                                        input_length=token_len,
+                                        name='focus_lookup')(token_input)
+            elif focus_input == 'embedding':
+                focus_chars = Embedding(input_dim=nb_chars + 1,
+                                        output_dim=nb_char_embedding_dims,
+                                        mask_zero=bucket_lengths,
+                                        input_length=token_len,
+                                        name='focus_embedding')(token_input)
+                nb_chars = nb_char_embedding_dims
+            else:
+                raise ValueError('Parameter `focus_input` not understood: use "onehot", "lookup" or "embedding".')
         inputs.append(token_input)
 
         if focus_repr == 'recurrent':
             # add recurrent layers to model focus token:
             for i in range(nb_encoding_layers):
                 if i == 0:
-                    curr_input = token_input
+                    curr_input = focus_chars
                 else:
                     curr_input = curr_enc_out
 
@@ -59,14 +100,14 @@ def build_model(token_len, token_char_vector_dict,
                                                   name='encoder_'+str(i+1)),
                                              merge_mode='sum')(curr_input)
         elif focus_repr == 'convolutions':
-            token_subnet = Convolution1D(input_shape=(token_len, len(token_char_vector_dict)),
+            token_subnet = Convolution1D(input_shape=(token_len, nb_chars),
                                          nb_filter=nb_filters,
                                          filter_length=filter_length,
                                          activation='relu',
                                          border_mode='valid',
                                          subsample_length=1,
                                          init='glorot_uniform',
-                                         name='focus_conv')(token_input)
+                                         name='focus_conv')(focus_chars)
             token_subnet = Flatten(name='focus_flat')(token_subnet)
             token_subnet = Dropout(dropout_level, name='focus_dropout1')(token_subnet)
             token_subnet = Dense(nb_dense_dims, name='focus_dense')(token_subnet)
@@ -187,21 +228,42 @@ def build_model(token_len, token_char_vector_dict,
 
         outputs.append(morph_label)
 
+    model = Model(input=inputs, output=outputs)
+    compile_model(model,
+                  focus_repr=focus_repr,
+                  include_lemma=include_lemma,
+                  include_pos=include_pos,
+                  include_morph=include_morph,
+                  sparse_targets=sparse_targets)
+    
+    return model
+
+def compile_model(model, focus_repr='recurrent',
+                  include_lemma=True, include_pos=True,
+                  include_morph=True, sparse_targets=False):
+    """
+    Compile a (built or reloaded) model with the losses
+    and optimizer used for training.
+    """
     loss_dict = {}
+    if sparse_targets:
+        # targets are integer indices instead of one-hot vectors:
+        categorical_loss = 'sparse_categorical_crossentropy'
+    else:
+        categorical_loss = 'categorical_crossentropy'
     if include_lemma:
-        loss_dict['lemma_out'] = 'categorical_crossentropy'
+        loss_dict['lemma_out'] = categorical_loss
     if include_pos:
-        loss_dict['pos_out'] = 'categorical_crossentropy'
+        loss_dict['pos_out'] = categorical_loss
     if include_morph:
         if include_morph == 'label':
-          loss_dict['morph_out'] = 'categorical_crossentropy'
+          loss_dict['morph_out'] = categorical_loss
         elif include_morph == 'multilabel':
           loss_dict['morph_out'] = 'binary_crossentropy'
     
-    model = Model(input=inputs, output=outputs)
     if focus_repr == 'convolutions':
         model.compile(optimizer='SGD', loss=loss_dict)
     else:
         model.compile(optimizer='RMSprop', loss=loss_dict)
     
-    return model
\ No newline at end of file
+    return model
@@ -0,0 +1,53 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Visualization of embeddings. This module pulls in matplotlib,
+seaborn and sklearn, so it should only be imported when
+something is actually plotted.
+"""
+
+from __future__ import print_function
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import seaborn as sns
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.manifold import TSNE
+
+
+def plot_embeddings(X, labels, outputfile, nb_clusters=8):
+    """
+    Project the rows of `X` to 2D with t-SNE, and write them
+    to `outputfile` as their labels, coloured by cluster.
+    """
+    # dimension reduction:
+    tsne = TSNE(n_components=2)
+    coor = tsne.fit_transform(X) # unsparsify
+
+    plt.clf()
+    sns.set_style('dark')
+    sns.plt.rcParams['axes.linewidth'] = 0.4
+    fig, ax1 = sns.plt.subplots()  
+
+    # first plot slices:
+    x1, x2 = coor[:,0], coor[:,1]
+    ax1.scatter(x1, x2, 100, edgecolors='none', facecolors='none')
+    # clustering on top (add some colouring):
+    clustering = AgglomerativeClustering(linkage='ward',
+                        affinity='euclidean', n_clusters=nb_clusters)
+    clustering.fit(coor)
+    # add names:
+    for x, y, name, cluster_label in zip(x1, x2, labels, clustering.labels_):
+        ax1.text(x, y, name, ha='center', va="center",
+                 color=plt.cm.spectral(cluster_label / 10.),
+                 fontdict={'family': 'Arial', 'size': 8})
+    # control aesthetics:
+    ax1.set_xlabel('')
+    ax1.set_ylabel('')
+    ax1.set_xticklabels([])
+    ax1.set_xticks([])
+    ax1.set_yticklabels([])
+    ax1.set_yticks([])
+    sns.plt.savefig(outputfile, bbox_inches=0)
+    sns.plt.close()
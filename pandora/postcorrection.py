@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from collections import OrderedDict
+
+import editdistance
+
+
+class LinearLemmaIndex():
+    """
+    Reference index: scans all known lemmas for every
+    query. Only useful for small lexicons or to check
+    the results of the other indices.
+    """
+
+    def __init__(self, lemmas):
+        self.lemmas = sorted(set(lemmas))
+
+    def __len__(self):
+        return len(self.lemmas)
+
+    def nearest(self, query):
+        """
+        Return the known lemma closest to `query` in
+        Levenshtein distance. Ties are broken by taking
+        the lexicographically smallest lemma.
+        """
+        return min(self.lemmas,
+                   key=lambda x: (editdistance.eval(x, query), x))
+
+
+class BKTreeLemmaIndex():
+    """
+    Burkhard-Keller tree over the known lemmas. Since
+    Levenshtein distance is a metric, whole subtrees can
+    be skipped using the triangle inequality, so that
+    only a fraction of the lexicon is compared against
+    each query.
+
+    The tree is stored as flat lists (one entry per node)
+    instead of nested objects, which keeps pickling fast
+    and avoids recursion limits on deep trees.
+    """
+
+    def __init__(self, lemmas):
+        self.words = []
+        self.children = []
+        # insert in sorted order, so that the tree (and
+        # its pickled representation) is reproducible:
+        for lemma in sorted(set(lemmas)):
+            self.add(lemma)
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, word):
+        if not self.words:
+            self.words.append(word)
+            self.children.append({})
+            return
+        node = 0
+        while True:
+            dist = editdistance.eval(word, self.words[node])
+            if dist == 0:
+                return
+            children = self.children[node]
+            if dist in children:
+                node = children[dist]
+            else:
+                children[dist] = len(self.words)
+                self.words.append(word)
+                self.children.append({})
+                return
+
+    def to_arrays(self):
+        """
+        Flat representation of the tree: the words of the
+        nodes, with, for each node, the index of its parent
+        and the distance to it (-1 for the root).
+        """
+        parents = [-1] * len(self.words)
+        edges = [-1] * len(self.words)
+        for node, children in enumerate(self.children):
+            for edge, child in children.items():
+                parents[child], edges[child] = node, edge
+        return self.words, parents, edges
+
+    @classmethod
+    def from_arrays(cls, words, parents, edges):
+        """ Inverse of `to_arrays()`: no distances are computed. """
+        index = cls([])
+        index.words = list(words)
+        index.children = [{} for _ in index.words]
+        for child, (parent, edge) in enumerate(zip(parents, edges)):
+            if parent >= 0:
+                index.children[parent][int(edge)] = child
+        return index
+
+    def nearest(self, query):
+        """
+        Return the known lemma closest to `query` in
+        Levenshtein distance. Ties are broken by taking
+        the lexicographically smallest lemma, so that the
+        result is identical to `LinearLemmaIndex.nearest()`.
+        """
+        if not self.words:
+            raise ValueError('Cannot search an empty lemma index.')
+
+        best_dist, best_word = None, None
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            word = self.words[node]
+            dist = editdistance.eval(query, word)
+            if best_dist is None or (dist, word) < (best_dist, best_word):
+                best_dist, best_word = dist, word
+                if dist == 0:
+                    break
+            # only visit children which can hold a lemma at
+            # distance <= best_dist (equality is needed to
+            # find all ties):
+            for edge, child in self.children[node].items():
+                if dist - best_dist <= edge <= dist + best_dist:
+                    stack.append(child)
+
+        return best_word
+
+
+LEMMA_INDICES = {'linear': LinearLemmaIndex,
+                 'bktree': BKTreeLemmaIndex}
+
+
+def build_lemma_index(lemmas, kind='bktree'):
+    try:
+        return LEMMA_INDICES[kind](lemmas)
+    except KeyError:
+        raise ValueError('Parameter `lemma_index` not understood: use one of ' + \
+                         ', '.join('"' + k + '"' for k in sorted(LEMMA_INDICES)) + '.')
+
+
+class LRUCache():
+    """
+    Bounded mapping which evicts the least recently used
+    entry once `maxsize` entries are stored. Hits and misses
+    are counted, so that the work saved can be reported.
+    A `maxsize` of 0 disables caching (but still counts).
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = int(maxsize)
+        self.items = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # re-insert to mark as most recently used:
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.items.pop(key, None)
+        self.items[key] = value
+        self.resize(self.maxsize)
+
+    def resize(self, maxsize):
+        self.maxsize = int(maxsize)
+        while len(self.items) > max(self.maxsize, 0):
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+        self.hits, self.misses = 0, 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
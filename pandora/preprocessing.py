@@ -3,14 +3,10 @@
 
 from __future__ import print_function
 from operator import itemgetter
-from collections import Counter
 
-from sklearn.preprocessing import LabelEncoder
-from sklearn.feature_extraction import DictVectorizer
-from keras.utils import np_utils
 import numpy as np
 
-from pandora.model import build_model
+from pandora.corpus import as_column
 
 def index_characters(tokens, focus_repr='recurrent', v2u=False):
     if v2u:
@@ -21,7 +17,14 @@ def index_characters(tokens, focus_repr='recurrent', v2u=False):
     if focus_repr == 'recurrent':
         vocab = vocab.union({'$', '|', '%'})
 
-    char_vocab = tuple(sorted(vocab))
+    return char_dicts(sorted(vocab))
+
+def char_dicts(char_vocab):
+    """
+    One-hot vector and index lookup for each character of
+    an ordered character vocabulary.
+    """
+    char_vocab = tuple(char_vocab)
     char_vector_dict, char_idx = {}, {}
     filler = np.zeros(len(char_vocab), dtype='float32')
 
@@ -33,37 +36,15 @@ def index_characters(tokens, focus_repr='recurrent', v2u=False):
 
     return char_vector_dict, char_idx
 
-def vectorize_tokens(tokens, char_vector_dict, focus_repr,
-                     max_len=15, v2u=False):
-    X = []
-    for token in tokens:
-        token = token.lower()
-        if v2u:
-            token.lower().replace('v', 'u')
-        x = vectorize_token(seq=token,
-                            char_vector_dict=char_vector_dict,
-                            max_len=max_len,
-                            focus_repr=focus_repr)
-        X.append(x)
-
-    return np.asarray(X, dtype='float32')
-
-
-def vectorize_lemmas(lemmas, char_vector_dict,
-                     max_len=15):
-    X = []
-    for lemma in lemmas:
-        lemma = lemma.lower()
-        x = vectorize_lemma(seq=lemma,
-                            char_vector_dict=char_vector_dict,
-                            max_len=max_len)
-        X.append(x)
-
-    X = np.asarray(X, dtype='float32')
-    return X
-
-def vectorize_token(seq, char_vector_dict, max_len, focus_repr):
+def char_index(char_vector_dict):
+    """
+    Map each character to the position of the
+    1 in its one-hot vector.
+    """
+    return {char: int(np.argmax(vec)) \
+                for char, vec in char_vector_dict.items()}
 
+def frame_token(seq, max_len, focus_repr):
     if focus_repr == 'recurrent':
         # cut, if needed:
         seq = seq[:(max_len - 2)]
@@ -71,40 +52,155 @@ def vectorize_token(seq, char_vector_dict, max_len, focus_repr):
         seq = seq[::-1] # reverse order (cf. paper)!
     elif focus_repr == 'convolutions':
         seq = seq[:max_len]
+    return seq
 
-    filler = np.zeros(len(char_vector_dict), dtype='float32')
+def frame_lemma(seq, max_len):
+    # cut, if needed (padding with '$' is done
+    # when encoding):
+    seq = seq[:(max_len - 2)]
+    return '%' + seq + '|'
+
+def encode_sequences(seqs, char_idx_dict, max_len, fill=-1):
+    """
+    Map all (framed) sequences to an int32 matrix of
+    character indices in one pass. Characters missing
+    from `char_idx_dict` get -1, positions beyond the
+    end of a sequence get `fill`.
+    """
+    ids = np.full((len(seqs), max_len), fill, dtype='int32')
+    lens = np.fromiter((len(seq) for seq in seqs),
+                       dtype='int64', count=len(seqs))
+    total = int(lens.sum())
+    if not total:
+        return ids
+
+    # look up all code points at once, through the
+    # sorted code points of the character vocabulary:
+    code_points = np.frombuffer(''.join(seqs).encode('utf-32-le', 'surrogatepass'),
+                                dtype='<u4')
+    vocab = sorted(char_idx_dict)
+    vocab_cps = np.array([ord(char) for char in vocab], dtype='<u4')
+    vocab_idxs = np.array([char_idx_dict[char] for char in vocab], dtype='int32')
+    char_ids = np.full(total, -1, dtype='int32')
+    if vocab:
+        pos = np.minimum(np.searchsorted(vocab_cps, code_points), len(vocab) - 1)
+        found = vocab_cps[pos] == code_points
+        char_ids[found] = vocab_idxs[pos[found]]
+
+    # scatter into the (row, column) positions:
+    rows = np.repeat(np.arange(len(seqs)), lens)
+    starts = np.cumsum(lens) - lens
+    cols = np.arange(total) - np.repeat(starts, lens)
+    ids[rows, cols] = char_ids
+    return ids
+
+def one_hot(ids, nb_chars):
+    """
+    Turn a matrix of character indices into a one-hot
+    float32 tensor; negative indices yield zero vectors.
+    """
+    X = np.zeros(ids.shape + (nb_chars,), dtype='float32')
+    rows, cols = np.nonzero(ids >= 0)
+    X[rows, cols, ids[rows, cols]] = 1
+    return X
 
-    seq_X = []
-    for char in seq:
-        try:
-            seq_X.append(char_vector_dict[char])
-        except KeyError:
-            seq_X.append(filler)
-    
-    while len(seq_X) < max_len:
-        seq_X.append(filler)
-    
-    return np.array(seq_X, dtype='float32')
+def encode_tokens(tokens, char_vector_dict, focus_repr,
+                  max_len=15, v2u=False):
+    seqs = []
+    for token in tokens:
+        token = token.lower()
+        if v2u:
+            token = token.replace('v', 'u')
+        seqs.append(frame_token(token, max_len, focus_repr))
 
-def vectorize_lemma(seq, char_vector_dict, max_len):
-    # cut, if needed:
-    seq = seq[:(max_len - 2)]
-    seq = '%'+seq+'|'
+    return encode_sequences(seqs, char_index(char_vector_dict), max_len)
 
-    # pad, if needed:
-    while len(seq) < max_len:
-        seq += '$'
+def vectorize_tokens(tokens, char_vector_dict, focus_repr,
+                     max_len=15, v2u=False):
+    ids = encode_tokens(tokens, char_vector_dict, focus_repr,
+                        max_len=max_len, v2u=v2u)
+    return one_hot(ids, len(char_vector_dict))
+
+def index_tokens(tokens, char_vector_dict, focus_repr,
+                 max_len=15, v2u=False):
+    """
+    Integer alternative to `vectorize_tokens()`: returns
+    char indices shifted by one, so that 0 can be used for
+    padding and unknown characters (cf. the zero vectors
+    in the one-hot representation).
+    """
+    return encode_tokens(tokens, char_vector_dict, focus_repr,
+                         max_len=max_len, v2u=v2u) + 1
 
-    seq_X = []
-    filler = np.zeros(len(char_vector_dict), dtype='float32')
 
-    for char in seq:
-        try:
-            seq_X.append(char_vector_dict[char])
-        except KeyError:
-            seq_X.append(filler)
+def vectorize_lemmas(lemmas, char_vector_dict,
+                     max_len=15):
+    seqs = [frame_lemma(lemma.lower(), max_len) for lemma in lemmas]
+    char_idx_dict = char_index(char_vector_dict)
+    ids = encode_sequences(seqs, char_idx_dict, max_len,
+                           fill=char_idx_dict.get('$', -1))
+    return one_hot(ids, len(char_vector_dict))
+
+def index_lemmas(lemmas, char_vector_dict, max_len=15):
+    """
+    Integer alternative to `vectorize_lemmas()`, for sparse
+    targets: returns a (nb_lemmas, max_len, 1) int32 tensor.
+    Unknown characters can't be left out of the loss as with
+    zero vectors, so they are mapped to the padding char.
+    """
+    seqs = [frame_lemma(lemma.lower(), max_len) for lemma in lemmas]
+    char_idx_dict = char_index(char_vector_dict)
+    ids = encode_sequences(seqs, char_idx_dict, max_len,
+                           fill=char_idx_dict.get('$', 0))
+    ids[ids < 0] = char_idx_dict.get('$', 0)
+    return ids[:, :, np.newaxis]
 
-    return np.array(seq_X, dtype='float32')
+def vectorize_token(seq, char_vector_dict, max_len, focus_repr):
+    ids = encode_sequences([frame_token(seq, max_len, focus_repr)],
+                           char_index(char_vector_dict), max_len)
+    return one_hot(ids, len(char_vector_dict))[0]
+
+def vectorize_lemma(seq, char_vector_dict, max_len):
+    char_idx_dict = char_index(char_vector_dict)
+    ids = encode_sequences([frame_lemma(seq, max_len)], char_idx_dict,
+                           max_len, fill=char_idx_dict.get('$', -1))
+    return one_hot(ids, len(char_vector_dict))[0]
+
+def decode_sequences(ids, char_idx):
+    """
+    Greedy decoding of a matrix of winning character indices
+    (one row per sequence): each row is cut at the first '|',
+    and the '$' and '%' characters are dropped.
+    """
+    nb_seqs, seq_len = ids.shape
+    if not nb_seqs or not seq_len:
+        return [''] * nb_seqs
+    chars = np.array([char_idx[i] for i in range(len(char_idx))], dtype='<U1')
+    # keep chars before the first '|', except '$' and '%':
+    before_end = np.cumsum((chars == '|')[ids], axis=1) == 0
+    skipped = (chars == '$') | (chars == '%')
+    keep = before_end & ~skipped[ids]
+    # move the kept chars to the front of each row (stable, so
+    # that their order is preserved) and blank the others:
+    order = np.argsort(~keep, axis=1, kind='mergesort')
+    rows = np.arange(nb_seqs)[:, np.newaxis]
+    out = chars[ids[rows, order]]
+    out[np.arange(seq_len) >= keep.sum(axis=1)[:, np.newaxis]] = ''
+    # read each row as one string (trailing blanks are dropped):
+    return out.view('<U%d' % seq_len).ravel().tolist()
+
+def morph_index_matrix(morph_idxs):
+    """
+    Padded (nb_categories, max_nb_values) matrix with the
+    column indices of each morph category's values (-1 for
+    padding), following the iteration order of `morph_idxs`.
+    """
+    idx_lists = [list(idxs) for idxs in morph_idxs.values()]
+    width = max([len(idxs) for idxs in idx_lists] or [0])
+    idx_matrix = np.full((len(idx_lists), width), -1, dtype='int64')
+    for i, idxs in enumerate(idx_lists):
+        idx_matrix[i, :len(idxs)] = idxs
+    return idx_matrix
 
 def parse_morphs(morph):
     morph_dicts = []
@@ -127,49 +223,58 @@ class Preprocessor():
 
     def fit(self, tokens, lemmas, pos, morph, include_lemma,
             include_morph, focus_repr, max_token_len = None,
-            min_lem_cnt = 1):
-        
+            min_lem_cnt = 1, focus_input = 'onehot',
+            sparse_targets = False):
+        from sklearn.preprocessing import LabelEncoder
+        from sklearn.feature_extraction import DictVectorizer
+
+        # only the distinct items are needed (see `pandora.corpus`):
+        tokens = as_column(tokens)
         if max_token_len:
             self.max_token_len = max_token_len
         else:
-            self.max_token_len = len(max(tokens, key=len)) + 1
+            self.max_token_len = len(max(tokens.vocab, key=len)) + 1
 
         self.focus_repr = focus_repr
+        self.focus_input = focus_input
+        self.sparse_targets = sparse_targets
         
         # fit focus tokens:
         self.token_char_dict, self.token_char_idx = \
-            index_characters(tokens, focus_repr=self.focus_repr)
-        self.known_tokens = set(tokens)
+            index_characters(tokens.vocab, focus_repr=self.focus_repr)
+        self.known_tokens = set(tokens.vocab)
         
         # fit lemmas:
         if lemmas:
+            lemmas = as_column(lemmas)
             self.include_lemma = include_lemma
-            self.known_lemmas = set(lemmas)
+            self.known_lemmas = set(lemmas.vocab)
             if include_lemma == 'generate':
-                self.max_lemma_len = len(max(lemmas, key=len)) + 1
+                self.max_lemma_len = len(max(lemmas.vocab, key=len)) + 1
                 self.lemma_char_dict, self.lemma_char_idx = \
-                    index_characters(lemmas)
+                    index_characters(lemmas.vocab)
             elif include_lemma == 'label':
                 self.min_lem_cnt = min_lem_cnt
-                cnt = Counter(lemmas)
-                trunc_lems = [k for k, v in cnt.items() if v >= self.min_lem_cnt]
+                trunc_lems = [k for k, v in zip(lemmas.vocab, lemmas.counts) \
+                                if v >= self.min_lem_cnt]
                 self.lemma_encoder = LabelEncoder()
                 self.lemma_encoder.fit(trunc_lems + ['<UNK>'])
 
         # fit pos labels:
         if pos:
             self.pos_encoder = LabelEncoder()
-            self.pos_encoder.fit(pos + ['<UNK>'])
+            self.pos_encoder.fit(as_column(pos).vocab + ['<UNK>'])
 
         if morph:
+            morph = as_column(morph)
             self.include_morph = include_morph
             if self.include_morph == 'label':
                 self.morph_encoder = LabelEncoder()
-                self.morph_encoder.fit(morph + ['<UNK>'])
+                self.morph_encoder.fit(morph.vocab + ['<UNK>'])
                 self.nb_morph_cats = len(self.morph_encoder.classes_)
             elif self.include_morph == 'multilabel':
                 # fit morph analysis:
-                morph_dicts = parse_morphs(morph)
+                morph_dicts = parse_morphs(morph.vocab)
                 self.morph_encoder = DictVectorizer(sparse=False)
                 self.morph_encoder.fit(morph_dicts)
                 self.nb_morph_cats = len(self.morph_encoder.feature_names_)
@@ -181,66 +286,98 @@ class Preprocessor():
                     except KeyError:
                         self.morph_idxs[label] = set()
                         self.morph_idxs[label].add(i)
+                self.morph_idx_matrix = morph_index_matrix(self.morph_idxs)
         
         return self
 
     def transform(self, tokens=None, lemmas=None,
                   pos=None, morph=None):
+        # each distinct item is only encoded once, and the
+        # result repeated for its occurrences (see `pandora.corpus`):
+        tokens = as_column(tokens)
+
         # vectorize focus tokens:
-        X_focus = vectorize_tokens(\
-                    tokens=tokens,
-                    char_vector_dict=self.token_char_dict,
-                    max_len=self.max_token_len,
-                    focus_repr=self.focus_repr)
+        if getattr(self, 'focus_input', 'onehot') == 'onehot':
+            X_focus = tokens.map_types(lambda vocab: vectorize_tokens(\
+                        tokens=vocab,
+                        char_vector_dict=self.token_char_dict,
+                        max_len=self.max_token_len,
+                        focus_repr=self.focus_repr))
+        else:
+            # char indices, to be embedded by the model:
+            X_focus = tokens.map_types(lambda vocab: index_tokens(\
+                        tokens=vocab,
+                        char_vector_dict=self.token_char_dict,
+                        max_len=self.max_token_len,
+                        focus_repr=self.focus_repr))
 
         returnables = {'X_focus': X_focus}
 
         if lemmas and self.include_lemma:
+            lemmas = as_column(lemmas)
             if self.include_lemma == 'generate':
                 # vectorize lemmas:
-                X_lemma = vectorize_lemmas(\
-                            lemmas=lemmas,
-                            char_vector_dict=self.lemma_char_dict,
-                            max_len=self.max_lemma_len)
+                if getattr(self, 'sparse_targets', False):
+                    X_lemma = lemmas.map_types(lambda vocab: index_lemmas(\
+                                lemmas=vocab,
+                                char_vector_dict=self.lemma_char_dict,
+                                max_len=self.max_lemma_len))
+                else:
+                    X_lemma = lemmas.map_types(lambda vocab: vectorize_lemmas(\
+                                lemmas=vocab,
+                                char_vector_dict=self.lemma_char_dict,
+                                max_len=self.max_lemma_len))
 
             elif self.include_lemma == 'label':
-                lemmas = [l if l in self.lemma_encoder.classes_ \
-                        else '<UNK>' for l in lemmas]
-                lemmas = self.lemma_encoder.transform(lemmas)
+                lemmas = lemmas.map_types(lambda vocab: self.lemma_encoder.transform(\
+                                [l if l in self.lemma_encoder.classes_ \
+                                    else '<UNK>' for l in vocab]))
             
-                X_lemma = np_utils.to_categorical(lemmas,
+                X_lemma = self.label_targets(lemmas,
                         nb_classes=len(self.lemma_encoder.classes_))
 
             returnables['X_lemma'] = X_lemma
 
         if pos:
             # vectorize pos:
-            pos = [p if p in self.pos_encoder.classes_ \
-                        else '<UNK>' for p in pos]
-            pos = self.pos_encoder.transform(pos)
+            pos = as_column(pos).map_types(lambda vocab: self.pos_encoder.transform(\
+                        [p if p in self.pos_encoder.classes_ \
+                            else '<UNK>' for p in vocab]))
             
-            X_pos = np_utils.to_categorical(pos,
+            X_pos = self.label_targets(pos,
                         nb_classes=len(self.pos_encoder.classes_))
             returnables['X_pos'] = X_pos
 
         if morph:
+            morph = as_column(morph)
             if self.include_morph == 'label':
-                morph = [m if m in self.morph_encoder.classes_ \
-                        else '<UNK>' for m in morph]
-                morph = self.morph_encoder.transform(morph)
+                morph = morph.map_types(lambda vocab: self.morph_encoder.transform(\
+                            [m if m in self.morph_encoder.classes_ \
+                                else '<UNK>' for m in vocab]))
             
-                X_morph = np_utils.to_categorical(morph,
+                X_morph = self.label_targets(morph,
                         nb_classes=len(self.morph_encoder.classes_))
                 returnables['X_morph'] = X_morph
 
             elif self.include_morph == 'multilabel':
                 # vectorize morph:
-                morph_dicts = parse_morphs(morph)
-                X_morph = self.morph_encoder.transform(morph_dicts)
+                X_morph = morph.map_types(lambda vocab: \
+                            self.morph_encoder.transform(parse_morphs(vocab)))
                 returnables['X_morph'] = X_morph
 
         return returnables
 
+    def label_targets(self, labels, nb_classes):
+        """
+        Encoded labels as targets: one-hot matrices, or,
+        with sparse targets, an (nb_labels, 1) int32 column
+        for sparse categorical cross-entropy.
+        """
+        if getattr(self, 'sparse_targets', False):
+            return np.asarray(labels, dtype='int32')[:, np.newaxis]
+        from keras.utils import np_utils
+        return np_utils.to_categorical(labels, nb_classes=nb_classes)
+
     def fit_transform(self, tokens, lemmas, pos, morph):
         self.fit(tokens, lemmas, pos, morph)
         return self.transform(tokens, lemmas, pos, morph)
@@ -254,18 +391,8 @@ class Preprocessor():
         """
         pred_lemmas = []
         if self.include_lemma == 'generate':
-            for pred in predictions:
-                pred_lem = ''
-                for positions in pred:
-                    top_idx = np.argmax(positions) # winning position
-                    c = self.lemma_char_idx[top_idx] # look up corresponding char
-                    if c in ('$', '%'):
-                        continue
-                    if c == '|':
-                        break
-                    else:
-                        pred_lem += c # add character
-                pred_lemmas.append(pred_lem)
+            pred_lemmas = decode_sequences(np.argmax(predictions, axis=2),
+                                           self.lemma_char_idx)
 
         elif self.include_lemma == 'label':
             predictions = np.argmax(predictions, axis=1)
@@ -288,17 +415,29 @@ class Preprocessor():
             predictions = np.argmax(predictions, axis=1)
             return self.morph_encoder.inverse_transform(predictions)
         elif self.include_morph == 'multilabel':
-            morphs = []
-            for pred in predictions:
-                m = []
-                for label, idxs in self.morph_idxs.items():
-                    scores = ((pred[idx], idx) for idx in idxs)
-                    max_score = max(scores, key=itemgetter(0))
-                    if max_score[0] >= threshold:
-                        m.append(self.morph_encoder.feature_names_[max_score[1]])
+            try:
+                idx_matrix = self.morph_idx_matrix
+            except AttributeError:
+                # preprocessors pickled before the matrix existed:
+                idx_matrix = self.morph_idx_matrix = morph_index_matrix(self.morph_idxs)
+            valid = idx_matrix >= 0
+            # scores of each category's values (padding gets -inf):
+            scores = predictions[:, np.where(valid, idx_matrix, 0)]
+            scores = np.where(valid, scores, -np.inf)
+            best = np.argmax(scores, axis=2)
+            best_scores = np.max(scores, axis=2)
+            best_idxs = idx_matrix[np.arange(idx_matrix.shape[0]), best]
+            best_idxs[best_scores < threshold] = -1
+            # assemble the strings once per distinct combination:
+            feature_names = self.morph_encoder.feature_names_
+            combinations, inverse = np.unique(best_idxs, axis=0, return_inverse=True)
+            combination_strs = []
+            for combination in combinations:
+                m = [feature_names[idx] for idx in combination if idx >= 0]
                 if m:
-                    morphs.append('|'.join(m))
+                    combination_strs.append('|'.join(m))
                 else:
-                    morphs.append('_')
+                    combination_strs.append('_')
+            morphs = [combination_strs[i] for i in inverse.ravel()]
         return morphs
         
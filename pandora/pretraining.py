@@ -2,24 +2,19 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-from collections import Counter
 from operator import itemgetter
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
-from gensim.models import Word2Vec
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.manifold import TSNE
+from numpy.lib.stride_tricks import as_strided
+
+from pandora.corpus import as_column
 
 
 class SentenceIterator:
     def __init__(self, tokens, sentence_len=100):
         
         self.sentence_len = sentence_len
-        self.tokens = [t.lower() for t in tokens]
+        self.tokens = as_column(tokens).lower()
         self.idxs = []
         start_idx, end_idx = 0, self.sentence_len
         while end_idx < len(self.tokens):
@@ -48,10 +43,26 @@ class Pretrainer:
         self.nb_workers = nb_workers
         self.nb_negative = nb_negative
 
-    def fit(self, tokens):
+    def __getstate__(self):
+        # the embedding model and the (lowercased) training
+        # corpus are only needed in fit(), don't pickle them:
+        state = self.__dict__.copy()
+        for attr in ('w2v_model', 'sentence_iterator'):
+            state.pop(attr, None)
+        return state
+
+    def fit(self, tokens, plot=False):
+        """
+        Train embeddings on `tokens` and index the train tokens.
+        With `plot`, the embeddings of the most frequent items
+        are plotted and their nearest neighbours written out,
+        which takes a while on large corpora.
+        """
+        from gensim.models import Word2Vec
+        # lowercase and count each distinct token once:
+        tokens = as_column(tokens).lower()
         # get most frequent items for plotting:
-        tokens = [t.lower() for t in tokens]
-        self.mfi = [t for t,_ in Counter(tokens).most_common(self.nb_mfi)]
+        self.mfi = tokens.most_common(self.nb_mfi)
         self.sentence_iterator = SentenceIterator(tokens=tokens)
         # train embeddings:
         self.w2v_model = Word2Vec(self.sentence_iterator,
@@ -60,13 +71,14 @@ class Pretrainer:
                              size=self.size,
                              workers=self.nb_workers,
                              negative=self.nb_negative)
-        self.plot_mfi()
-        self.most_similar()
+        if plot:
+            self.plot_mfi()
+            self.most_similar()
 
         # build an index of the train tokens
         # which occur at least min_count times:
         self.token_idx = {'<UNK>': 0}
-        for k, v in Counter(tokens).items():
+        for k, v in zip(tokens.vocab, tokens.counts):
             if v >= self.minimum_count:
                 self.token_idx[k] = len(self.token_idx)
         
@@ -87,78 +99,38 @@ class Pretrainer:
                 weights.append(unk)
         return [np.asarray(weights, dtype='float32')]
 
-    def transform(self, tokens):
-
-        context_ints = []
-        tokens = [t.lower() for t in tokens]
-        for curr_idx, token in enumerate(tokens):
-            ints = []
-            # vectorize left context:
-            left_context_tokens = [tokens[curr_idx-(t+1)]\
-                                    for t in range(self.nb_left_tokens)\
-                                        if curr_idx-(t+1) >= 0][::-1]
-            
-            idxs = []
-            if left_context_tokens:
-                idxs = [self.token_idx[t] if t in self.token_idx else 0 \
-                            for t in left_context_tokens]
-            while len(idxs) < self.nb_left_tokens:
-                idxs = [0] + idxs
-            ints.extend(idxs)
-
-            # vectorize right context
-            right_context_tokens = [tokens[curr_idx+(t+1)]\
-                                        for t in range(self.nb_right_tokens)\
-                                            if curr_idx+(t+1) < len(tokens)]
-            
-            idxs = []
-            if right_context_tokens:
-                idxs = [self.token_idx[t] if t in self.token_idx else 0 \
-                            for t in right_context_tokens]
-            while len(idxs) < self.nb_right_tokens:
-                idxs.append(0)
-            ints.extend(idxs)
-
-            context_ints.append(ints)
-
-        return np.asarray(context_ints, dtype='int32')
-
+    def transform(self, tokens, idxs=None):
+        """
+        Return an (nb_tokens, nb_left_tokens + nb_right_tokens)
+        int32 matrix with the indices of the context tokens of
+        each token (0 for unknown tokens and for positions
+        beyond the edges of the token sequence). If `idxs` is
+        given, only the rows of the tokens at those positions
+        are built (in that order).
+        """
+        # map each distinct token to its index once:
+        ids = as_column(tokens).map_types(lambda vocab: np.fromiter(\
+                            (self.token_idx.get(t.lower(), 0) for t in vocab),
+                            dtype='int32', count=len(vocab)))
+        # pad at both edges, then slide a window over the ids:
+        padded = np.concatenate((np.zeros(self.nb_left_tokens, dtype='int32'),
+                                 ids,
+                                 np.zeros(self.nb_right_tokens, dtype='int32')))
+        width = self.nb_left_tokens + 1 + self.nb_right_tokens
+        windows = as_strided(padded, shape=(len(ids), width),
+                             strides=(padded.strides[0], padded.strides[0]))
+        if idxs is not None:
+            windows = windows[np.asarray(idxs, dtype='int64')]
+        # drop the focus token itself (this copies the view):
+        return np.delete(windows, self.nb_left_tokens, axis=1)
 
     def plot_mfi(self, outputfile='embeddings.pdf', nb_clusters=8, weights='NA'):
+        from pandora.plotting import plot_embeddings
         # collect embeddings for mfi:
-        X = np.asarray([self.w2v_model[w] for w in self.mfi \
-                            if w in self.w2v_model], dtype='float32')
-        # dimension reduction:
-        tsne = TSNE(n_components=2)
-        coor = tsne.fit_transform(X) # unsparsify
-
-        plt.clf()
-        sns.set_style('dark')
-        sns.plt.rcParams['axes.linewidth'] = 0.4
-        fig, ax1 = sns.plt.subplots()  
-
-        labels = self.mfi
-        # first plot slices:
-        x1, x2 = coor[:,0], coor[:,1]
-        ax1.scatter(x1, x2, 100, edgecolors='none', facecolors='none')
-        # clustering on top (add some colouring):
-        clustering = AgglomerativeClustering(linkage='ward',
-                            affinity='euclidean', n_clusters=nb_clusters)
-        clustering.fit(coor)
-        # add names:
-        for x, y, name, cluster_label in zip(x1, x2, labels, clustering.labels_):
-            ax1.text(x, y, name, ha='center', va="center",
-                     color=plt.cm.spectral(cluster_label / 10.),
-                     fontdict={'family': 'Arial', 'size': 8})
-        # control aesthetics:
-        ax1.set_xlabel('')
-        ax1.set_ylabel('')
-        ax1.set_xticklabels([])
-        ax1.set_xticks([])
-        ax1.set_yticklabels([])
-        ax1.set_yticks([])
-        sns.plt.savefig(outputfile, bbox_inches=0)
-        sns.plt.close()
+        labels = [w for w in self.mfi if w in self.w2v_model]
+        X = np.asarray([self.w2v_model[w] for w in labels], dtype='float32')
+        plot_embeddings(X, labels=labels, outputfile=outputfile,
+                        nb_clusters=nb_clusters)
 
     def most_similar(self, nb_neighbors=5,
                      words=['doet', 'goet', 'ende', 'mach', 'gode'],
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+import pandora.utils as utils
+
+
+class _Request():
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.result, self.error = None, None
+        self.done = threading.Event()
+
+
+class MicroBatcher():
+    """
+    Collects concurrent annotation requests and runs them
+    through `Tagger.annotate_batch()` together. A batch is
+    closed as soon as it holds `max_batch_tokens` tokens, or
+    `max_latency` seconds after its first request arrived,
+    whichever comes first. All calls to the model happen in
+    a single worker thread.
+    """
+
+    def __init__(self, tagger, max_batch_tokens=4096, max_latency=.01):
+        self.tagger = tagger
+        self.max_batch_tokens = int(max_batch_tokens)
+        self.max_latency = float(max_latency)
+        self.requests = queue.Queue()
+        self.nb_batches, self.nb_requests, self.nb_tokens = 0, 0, 0
+
+        # build the prediction function in the loading thread, so
+        # that the worker thread uses the same graph:
+        if hasattr(self.tagger.model, '_make_predict_function'):
+            self.tagger.model._make_predict_function()
+
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def annotate(self, tokens):
+        request = _Request(tokens)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        return {'batches': self.nb_batches,
+                'requests': self.nb_requests,
+                'tokens': self.nb_tokens,
+                'mean_batch_requests': float(self.nb_requests) / max(self.nb_batches, 1),
+                'mean_batch_tokens': float(self.nb_tokens) / max(self.nb_batches, 1),
+                'prediction_cache': self.tagger.prediction_stats()}
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        nb_tokens = len(batch[0].tokens)
+        deadline = time.time() + self.max_latency
+        while nb_tokens < self.max_batch_tokens:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            nb_tokens += len(request.tokens)
+        return batch, nb_tokens
+
+    def _run(self):
+        while True:
+            batch, nb_tokens = self._collect()
+            try:
+                results = self.tagger.annotate_batch([r.tokens for r in batch])
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finally:
+                self.nb_batches += 1
+                self.nb_requests += len(batch)
+                self.nb_tokens += nb_tokens
+                for request in batch:
+                    request.done.set()
+
+
+class AnnotationHandler(BaseHTTPRequestHandler):
+    """
+    POST /annotate with a JSON body holding either a list of
+    `tokens` or a `text` to tokenize; answers with the JSON
+    annotation dict. GET /stats reports batching and prediction
+    cache statistics.
+    """
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {'error': 'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/annotate':
+            return self._reply(404, {'error': 'Unknown path: ' + self.path})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf8'))
+            if not isinstance(body, dict):
+                raise ValueError('expected a JSON object')
+            if 'tokens' in body:
+                if not isinstance(body['tokens'], list):
+                    raise ValueError('`tokens` should be a list')
+                tokens, text = [str(t) for t in body['tokens']], None
+            elif 'text' in body:
+                tokens, text = None, body['text'].strip()
+            else:
+                raise ValueError('expected `tokens` or `text`')
+            if not (tokens or text):
+                raise ValueError('nothing to annotate')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self._reply(400, {'error': 'Invalid request: ' + str(e)})
+        try:
+            if tokens is None:
+                tokens = utils.tokenize_text(text)
+            annotations = self.server.batcher.annotate(tokens)
+            content = {k: list(v) for k, v in annotations.items()}
+        except Exception as e:
+            self.log_error('Annotation failed: %r', e)
+            return self._reply(500, {'error': 'Annotation failed: ' + str(e)})
+        self._reply(200, content)
+
+    def _reply(self, status, content):
+        payload = json.dumps(content, ensure_ascii=False).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        # Unix sockets have no client address:
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'unix-socket'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(tagger, host='127.0.0.1', port=8080, socket_path=None,
+          max_batch_tokens=4096, max_latency=.01):
+    """
+    Serve a loaded tagger over HTTP, on a TCP port or on a
+    Unix socket (if `socket_path` is given), until interrupted.
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, AnnotationHandler)
+        print('Serving on unix socket', socket_path)
+    else:
+        server = ThreadingHTTPServer((host, int(port)), AnnotationHandler)
+        print('Serving on http://{}:{}/annotate'.format(host, port))
+    server.batcher = MicroBatcher(tagger,
+                                  max_batch_tokens=max_batch_tokens,
+                                  max_latency=max_latency)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
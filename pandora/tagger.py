@@ -6,29 +6,43 @@ import pickle
 import os
 import codecs
 import shutil
+import threading
+from itertools import islice
 from operator import itemgetter
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
-from gensim.models import Word2Vec
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.manifold import TSNE
 
-import keras.backend as K
-from keras.utils import np_utils
 from keras.models import model_from_json
 from keras import backend as K
 
-import editdistance
-
 import pandora.utils as utils
 import pandora.evaluation as evaluation
-from pandora.model import build_model
+import pandora.bucketing as bucketing
 from pandora.preprocessing import Preprocessor
 from pandora.pretraining import Pretrainer
+from pandora.corpus import Corpus, as_column
+from pandora.postcorrection import build_lemma_index, LRUCache, LEMMA_INDICES
+from pandora.bundle import has_bundle, load_bundle, save_bundle
+from pandora.cache import DatasetCache, fingerprint, data_fingerprint
+from pandora.decoding import build_lemma_trie
+
+
+# vectorized data and (string) tokens and labels, per split,
+# saved by Tagger.save_dataset():
+DATASET_ARRAYS = ('X_focus', 'contexts', 'X_lemma', 'X_pos', 'X_morph',
+                  'tokens', 'lemmas', 'pos', 'morph')
+DATASET_LABELS = ('tokens', 'lemmas', 'pos', 'morph')
+
+# parameters which determine the fitted preprocessor and
+# pretrainer (cf. Tagger.setup_to_train()):
+FIT_PARAMS = ('include_lemma', 'include_pos', 'include_morph', 'max_token_len',
+              'focus_repr', 'focus_input', 'sparse_targets', 'min_lem_cnt',
+              'nb_left_tokens', 'nb_right_tokens', 'nb_embedding_dims',
+              'min_token_freq_emb')
 
 
 class Tagger():
@@ -52,6 +66,9 @@ class Tagger():
                  nb_filters = 100,
                  filter_length = 3,
                  focus_repr = 'recurrent',
+                 focus_input = 'onehot',
+                 nb_char_embedding_dims = 50,
+                 sparse_targets = False,
                  dropout_level = .1,
                  load = False,
                  nb_epochs = 15,
@@ -59,6 +76,23 @@ class Tagger():
                  halve_lr_at = 10,
                  max_token_len = None,
                  min_lem_cnt = 1,
+                 lemma_index = 'bktree',
+                 correction_cache_size = 100000,
+                 persist_correction_cache = False,
+                 prediction_cache_size = 100000,
+                 stream_train = False,
+                 shuffle_buffer = 10000,
+                 eval_train = True,
+                 eval_train_every = 1,
+                 eval_train_size = 0,
+                 plot_pretraining = False,
+                 keep_best_on = None,
+                 dataset_cache = None,
+                 resumable = False,
+                 nb_length_buckets = 0,
+                 lemma_decoder = 'greedy',
+                 beam_width = 10,
+                 novel_lemma_threshold = None,
                  overwrite=None
                  ):
         
@@ -83,6 +117,9 @@ class Tagger():
             self.nb_filters = int(nb_filters)
             self.filter_length = int(filter_length)
             self.focus_repr = focus_repr
+            self.focus_input = focus_input
+            self.nb_char_embedding_dims = int(nb_char_embedding_dims)
+            self.sparse_targets = bool(sparse_targets)
             self.dropout_level = float(dropout_level)
             self.include_token = include_token
             self.include_context = include_context
@@ -96,6 +133,23 @@ class Tagger():
             self.halve_lr_at = int(halve_lr_at)
             self.max_token_len = int(max_token_len)
             self.min_lem_cnt = int(min_lem_cnt)
+            self.lemma_index = lemma_index
+            self.correction_cache_size = int(correction_cache_size)
+            self.persist_correction_cache = bool(persist_correction_cache)
+            self.prediction_cache_size = int(prediction_cache_size)
+            self.stream_train = bool(stream_train)
+            self.shuffle_buffer = int(shuffle_buffer)
+            self.eval_train = bool(eval_train)
+            self.eval_train_every = int(eval_train_every)
+            self.eval_train_size = int(eval_train_size)
+            self.plot_pretraining = bool(plot_pretraining)
+            self.keep_best_on = keep_best_on
+            self.dataset_cache = dataset_cache
+            self.resumable = bool(resumable)
+            self.nb_length_buckets = int(nb_length_buckets)
+            self.lemma_decoder = lemma_decoder
+            self.beam_width = int(beam_width)
+            self.novel_lemma_threshold = novel_lemma_threshold
 
         else:
             param_dict = utils.get_param_dict(self.config_path)
@@ -113,6 +167,10 @@ class Tagger():
             self.nb_filters = int(param_dict['nb_filters'])
             self.filter_length = int(param_dict['filter_length'])
             self.focus_repr = param_dict['focus_repr']
+            self.focus_input = param_dict.get('focus_input', focus_input)
+            self.nb_char_embedding_dims = int(param_dict.get('nb_char_embedding_dims',
+                                                             nb_char_embedding_dims))
+            self.sparse_targets = bool(param_dict.get('sparse_targets', sparse_targets))
             self.dropout_level = float(param_dict['dropout_level'])
             self.include_token = param_dict['include_token']
             self.include_context = param_dict['include_context']
@@ -125,11 +183,43 @@ class Tagger():
             self.halve_lr_at = int(param_dict['halve_lr_at'])
             self.max_token_len = int(param_dict['max_token_len'])
             self.min_lem_cnt = int(param_dict['min_lem_cnt'])
+            self.lemma_index = param_dict.get('lemma_index', lemma_index)
+            self.correction_cache_size = int(param_dict.get('correction_cache_size',
+                                                            correction_cache_size))
+            self.persist_correction_cache = bool(param_dict.get('persist_correction_cache',
+                                                                persist_correction_cache))
+            self.prediction_cache_size = int(param_dict.get('prediction_cache_size',
+                                                            prediction_cache_size))
+            self.stream_train = bool(param_dict.get('stream_train', stream_train))
+            self.shuffle_buffer = int(param_dict.get('shuffle_buffer', shuffle_buffer))
+            self.eval_train = bool(param_dict.get('eval_train', eval_train))
+            self.eval_train_every = int(param_dict.get('eval_train_every', eval_train_every))
+            self.eval_train_size = int(param_dict.get('eval_train_size', eval_train_size))
+            self.plot_pretraining = bool(param_dict.get('plot_pretraining', plot_pretraining))
+            self.keep_best_on = param_dict.get('keep_best_on', keep_best_on)
+            self.dataset_cache = param_dict.get('dataset_cache', dataset_cache)
+            self.resumable = bool(param_dict.get('resumable', resumable))
+            self.nb_length_buckets = int(param_dict.get('nb_length_buckets', nb_length_buckets))
+            self.lemma_decoder = param_dict.get('lemma_decoder', lemma_decoder)
+            self.beam_width = int(param_dict.get('beam_width', beam_width))
+            self.novel_lemma_threshold = param_dict.get('novel_lemma_threshold',
+                                                        novel_lemma_threshold)
 
         if overwrite is not None:
             # Overwrite should be a dict of attributes to change value of the trainer
             for key, value in overwrite.items():
                 self.__setattr__(key, value)
+
+        if self.keep_best_on in ('', 'None'):
+            self.keep_best_on = None
+        if self.dataset_cache in ('', 'None'):
+            self.dataset_cache = None
+        if self.novel_lemma_threshold in ('', 'None'):
+            self.novel_lemma_threshold = None
+        if self.novel_lemma_threshold is not None:
+            self.novel_lemma_threshold = float(self.novel_lemma_threshold)
+        if self.lemma_decoder not in ('greedy', 'beam'):
+            raise ValueError('Parameter `lemma_decoder` not understood: use "greedy" or "beam".')
         
         # create a models directory if it isn't there already:
         if not os.path.isdir(self.model_dir):
@@ -138,56 +228,253 @@ class Tagger():
         # initialize:
         self.setup = False
         self.curr_nb_epochs = 0
+        self.best_score, self.best_epoch = None, None
 
         self.train_tokens, self.dev_tokens, self.test_tokens = None, None, None
         self.train_lemmas, self.dev_lemmas, self.test_lemmas = None, None, None
         self.train_pos, self.dev_pos, self.test_pos = None, None, None
         self.train_morph, self.dev_morph, self.test_morph = None, None, None
+        self.train_stream = None
+        self.lemma_trie = None
+        # keys of the cache entries holding the fitted transformers
+        # and the vectorized splits (with `dataset_cache`):
+        self.fit_key, self.dataset_keys = None, {}
+
+        # decoded predictions per distinct input (see `predict_decoded()`):
+        self.prediction_cache = LRUCache(maxsize=self.prediction_cache_size)
+        self.nb_annotated_tokens, self.nb_predicted_tokens = 0, 0
 
         if load:
             self.load()
 
-    def load(self):
-        print('Re-loading preprocessor...')
-        self.preprocessor = pickle.load(open(os.sep.join((self.model_dir, \
-                                    'preprocessor.p')), 'rb'))
-        print('Re-loading pretrainer...')
-        self.pretrainer = pickle.load(open(os.sep.join((self.model_dir, \
-                                    'pretrainer.p')), 'rb'))
+    def load(self, latest=False):
+        """
+        Load the tagger saved in the model directory. If
+        `keep_best_on` is set, the best weights are loaded,
+        unless `latest` is set (e.g. to resume training).
+        """
+        from pandora.model import compile_model
+
+        loaded = {}
+        if has_bundle(self.model_dir):
+            print('Re-loading model bundle...')
+            loaded = load_bundle(self.model_dir)
+            self.preprocessor = loaded['preprocessor']
+            self.pretrainer = loaded['pretrainer']
+        else:
+            # model directories saved before the bundle format:
+            print('Re-loading preprocessor...')
+            self.preprocessor = pickle.load(open(os.sep.join((self.model_dir, \
+                                        'preprocessor.p')), 'rb'))
+            print('Re-loading pretrainer...')
+            self.pretrainer = pickle.load(open(os.sep.join((self.model_dir, \
+                                        'pretrainer.p')), 'rb'))
         print('Re-building model...')
         self.model = model_from_json(open(os.sep.join((self.model_dir, 'model_architecture.json'))).read())
-        self.model.load_weights(os.sep.join((self.model_dir, 'model_weights.hdf5')))
+        weights_path = os.sep.join((self.model_dir, 'model_weights.hdf5'))
+        best_weights_path = os.sep.join((self.model_dir, 'model_weights_best.hdf5'))
+        if self.keep_best_on and not latest and os.path.isfile(best_weights_path):
+            print('Loading the weights with the best', self.keep_best_on, '...')
+            weights_path = best_weights_path
+        self.model.load_weights(weights_path)
+        self.prediction_cache.clear()
 
-        loss_dict = {}
         idx_cnt = 0
         if self.include_lemma:
-            loss_dict['lemma_out'] = 'categorical_crossentropy'
             self.lemma_out_idx = idx_cnt
             idx_cnt += 1
-            print('Loading known lemmas...')
-            self.known_lemmas = pickle.load(open(os.sep.join((self.model_dir, \
-                                    'known_lemmas.p')), 'rb'))
+            index_path = os.sep.join((self.model_dir, 'lemma_index.p'))
+            if loaded:
+                self.known_lemmas = loaded['known_lemmas']
+                self.lemma_trie = loaded.get('lemma_trie')
+            else:
+                print('Loading known lemmas...')
+                self.known_lemmas = pickle.load(open(os.sep.join((self.model_dir, \
+                                        'known_lemmas.p')), 'rb'))
+            if loaded.get('known_lemma_index') is not None and \
+                    isinstance(loaded['known_lemma_index'], LEMMA_INDICES.get(self.lemma_index, ())):
+                self.known_lemma_index = loaded['known_lemma_index']
+            elif not loaded and os.path.isfile(index_path):
+                print('Loading lemma index...')
+                self.known_lemma_index = pickle.load(open(index_path, 'rb'))
+            else:
+                # older model directories only ship the known lemmas
+                # (or another kind of index was asked for):
+                print('Building lemma index...')
+                self.known_lemma_index = build_lemma_index(self.known_lemmas,
+                                                           kind=self.lemma_index)
+            self.load_correction_cache()
 
         if self.include_pos:
-            loss_dict['pos_out'] = 'categorical_crossentropy'
             self.pos_out_idx = idx_cnt
             idx_cnt += 1
         if self.include_morph:
             self.morph_out_idx = idx_cnt
             idx_cnt += 1
-            if self.include_morph == 'label':
-              loss_dict['morph_out'] = 'categorical_crossentropy'
-            elif self.include_morph == 'multilabel':
-              loss_dict['morph_out'] = 'binary_crossentropy'
 
-        self.model.compile(optimizer='adadelta', loss=loss_dict)
+        # same losses and optimizer as in build_model():
+        compile_model(self.model,
+                      focus_repr=self.focus_repr,
+                      include_lemma=self.include_lemma,
+                      include_pos=self.include_pos,
+                      include_morph=self.include_morph,
+                      sparse_targets=self.sparse_targets)
+
+    def resume(self, train_stream=None):
+        """
+        Continue an interrupted training run from the last
+        checkpoint in the model directory: the latest weights,
+        the optimizer state (including the learning rate, as
+        lowered by `halve_lr_at`) and the epoch counter are
+        restored, and the vectorized data is reloaded from the
+        dataset saved by `setup_to_train()`, which requires the
+        run to be `resumable`. With `dataset_cache`, the vectors
+        are memory-mapped from the cache entries of the run. With
+        `stream_train`, the same `train_stream` should be passed
+        again.
+        """
+        if not self.resumable:
+            raise ValueError('Only runs set up with `resumable = True` can be resumed.')
+        self.load(latest=True)
+
+        with open(os.sep.join((self.model_dir, 'training_state.p')), 'rb') as f:
+            state = pickle.load(f)
+        self.fit_key = state.get('fit_key')
+        self.dataset_keys = state.get('dataset_keys', {})
+        self.load_dataset()
+
+        self.curr_nb_epochs = state['curr_nb_epochs']
+        self.best_score, self.best_epoch = state['best_score'], state['best_epoch']
+        if state['optimizer_weights']:
+            # the optimizer only creates its weights along
+            # with the training function:
+            self.model._make_train_function()
+            self.model.optimizer.set_weights(state['optimizer_weights'])
+        K.set_value(self.model.optimizer.lr, np.float32(state['lr']))
+        print('Resuming after epoch', self.curr_nb_epochs,
+              '(learning rate:', state['lr'], ')')
+
+        self.train_stream = train_stream
+        self.setup_train_eval()
+        self.setup = True
+
+    def vectorize_split(self, split, cache=None, fit_key=None):
+        """
+        Vectorize the tokens and labels of a split ('train',
+        'dev' or 'test'), through the cache if one is given.
+        Returns a dict with the `X_focus` and `contexts` inputs
+        and the `X_lemma`, `X_pos` and `X_morph` targets.
+        """
+        tokens = getattr(self, split + '_tokens')
+        lemmas = getattr(self, split + '_lemmas')
+        pos = getattr(self, split + '_pos')
+        morph = getattr(self, split + '_morph')
+
+        key = None
+        if cache:
+            key = fingerprint('vectors', fit_key,
+                              data_fingerprint({'token': tokens, 'lemma': lemmas,
+                                                'pos': pos, 'morph': morph}))
+            self.dataset_keys[split] = key
+            tensors = cache.load(key)
+            if tensors is not None:
+                print('Loading vectorized', split, 'data from cache', key[:10], '...')
+                return tensors
+
+        transformed = self.preprocessor.transform(tokens=tokens,
+                                                  lemmas=lemmas,
+                                                  pos=pos,
+                                                  morph=morph)
+        tensors = {'X_focus': transformed['X_focus'],
+                   'contexts': self.pretrainer.transform(tokens=tokens)}
+        for name in ('X_lemma', 'X_pos', 'X_morph'):
+            if name in transformed:
+                tensors[name] = transformed[name]
+        if cache:
+            cache.save(key, tensors)
+        return tensors
+
+    def save_dataset(self):
+        """
+        Save the vectorized data (and the tokens and labels used
+        for evaluation) to the `dataset` folder of the model
+        directory, as .npy files, so that `resume()` does not
+        need to load and vectorize the corpora again. Splits
+        which are stored in the dataset cache (cf. `dataset_keys`)
+        are not copied: only their tokens and labels are saved.
+        """
+        path = os.sep.join((self.model_dir, 'dataset'))
+        tmp_path = path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for split in ('train', 'dev', 'test'):
+            for name in DATASET_ARRAYS:
+                value = getattr(self, split + '_' + name, None)
+                if value is None:
+                    continue
+                if split in self.dataset_keys and name not in DATASET_LABELS:
+                    continue
+                if name in DATASET_LABELS:
+                    value = np.array([str(x) for x in value], dtype=str)
+                np.save(os.sep.join((tmp_path, split + '_' + name + '.npy')), value,
+                        allow_pickle=False)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def load_dataset(self):
+        if self.dataset_keys:
+            cache = DatasetCache(self.dataset_cache)
+            for split, key in self.dataset_keys.items():
+                tensors = cache.load(key)
+                if tensors is None:
+                    raise ValueError('The cached ' + split + ' data (' + key[:10] + \
+                                     ') is missing from ' + str(self.dataset_cache))
+                print('Re-loading vectorized', split, 'data from cache', key[:10], '...')
+                for name, value in tensors.items():
+                    setattr(self, split + '_' + name, value)
+        path = os.sep.join((self.model_dir, 'dataset'))
+        print('Re-loading dataset...')
+        for filename in os.listdir(path):
+            name, ext = os.path.splitext(filename)
+            if ext != '.npy':
+                continue
+            value = np.load(os.sep.join((path, filename)), mmap_mode='r',
+                            allow_pickle=False)
+            if name.split('_', 1)[1] in DATASET_LABELS:
+                value = value.tolist()
+            setattr(self, name, value)
+
+    def setup_to_train(self, train_data=None, dev_data=None, test_data=None,
+                       train_stream=None):
+        """
+        If `train_stream` is given (a callable returning an
+        iterable of instance dicts, e.g. a partial application
+        of `utils.iter_annotated_dir()`), the training data is
+        only used to fit the preprocessor and the pretrainer:
+        training tensors are then vectorized per batch from the
+        stream instead of being held in memory. Each epoch reads
+        the stream from its start, and lasts as many instances
+        as there are train tokens, i.e. one pass when the stream
+        yields the same instances as `train_data`.
+        """
+        # training-only dependency, not needed to load a model:
+        from pandora.model import build_model
 
-    def setup_to_train(self, train_data=None, dev_data=None, test_data=None):
         # create a model directory:
         if os.path.isdir(self.model_dir):
             shutil.rmtree(self.model_dir)
         os.mkdir(self.model_dir)
 
+        # intern the columns of the corpora once, so that fitting and
+        # evaluation work on the distinct items (see `pandora.corpus`):
+        train_data = Corpus(train_data)
+        if self.include_test:
+            test_data = Corpus(test_data)
+        if self.include_dev:
+            dev_data = Corpus(dev_data)
+
         self.train_tokens = train_data['token']
         if self.include_test:
             self.test_tokens = test_data['token']
@@ -199,7 +486,12 @@ class Tagger():
             self.lemma_out_idx = idx_cnt
             idx_cnt += 1
             self.train_lemmas = train_data['lemma']
-            self.known_lemmas = set(self.train_lemmas)
+            self.known_lemmas = set(self.train_lemmas.vocab)
+            self.known_lemma_index = build_lemma_index(self.known_lemmas,
+                                                       kind=self.lemma_index)
+            self.correction_cache = LRUCache(maxsize=self.correction_cache_size)
+            # (built once the preprocessor is fitted):
+            self.lemma_trie = None
             if self.include_dev:
                 self.dev_lemmas = dev_data['lemma']            
             if self.include_test:
@@ -220,70 +512,63 @@ class Tagger():
             if self.include_test:
                 self.test_morph = test_data['morph']
 
-        self.preprocessor = Preprocessor().fit(tokens=self.train_tokens,
-                                               lemmas=self.train_lemmas,
-                                               pos=self.train_pos,
-                                               morph=self.train_morph,
-                                               include_lemma=self.include_lemma,
-                                               include_morph=self.include_morph,
-                                               max_token_len=self.max_token_len,
-                                               focus_repr=self.focus_repr,
-                                               min_lem_cnt=self.min_lem_cnt,
-                                               )
-        self.pretrainer = Pretrainer(nb_left_tokens=self.nb_left_tokens,
-                                     nb_right_tokens=self.nb_right_tokens,
-                                     size=self.nb_embedding_dims,
-                                     minimum_count=self.min_token_freq_emb)
-        self.pretrainer.fit(tokens=self.train_tokens)
-
-        train_transformed = self.preprocessor.transform(tokens=self.train_tokens,
-                                               lemmas=self.train_lemmas,
-                                               pos=self.train_pos,
-                                               morph=self.train_morph)
-        if self.include_dev:
-            dev_transformed = self.preprocessor.transform(tokens=self.dev_tokens,
-                                        lemmas=self.dev_lemmas,
-                                        pos=self.dev_pos,
-                                        morph=self.dev_morph)
-        if self.include_test:
-            test_transformed = self.preprocessor.transform(tokens=self.test_tokens,
-                                        lemmas=self.test_lemmas,
-                                        pos=self.test_pos,
-                                        morph=self.test_morph)
+        cache = None
+        self.dataset_keys = {}
+        if self.dataset_cache:
+            cache = DatasetCache(self.dataset_cache)
 
-        self.train_X_focus = train_transformed['X_focus']
-        if self.include_dev:
-            self.dev_X_focus = dev_transformed['X_focus']
-        if self.include_test:
-            self.test_X_focus = test_transformed['X_focus']
+        # fit the preprocessor and pretrain embeddings:
+        self.fit_key = fit_key = fingerprint('fit',
+                              data_fingerprint({'token': self.train_tokens,
+                                                'lemma': self.train_lemmas,
+                                                'pos': self.train_pos,
+                                                'morph': self.train_morph}),
+                              {k: getattr(self, k) for k in FIT_PARAMS})
+        fitted = cache.load(fit_key) if cache else None
+        if fitted is not None:
+            print('Loading fitted preprocessor and pretrainer from cache', fit_key[:10], '...')
+            self.preprocessor = fitted['preprocessor']
+            self.pretrainer = fitted['pretrainer']
+        else:
+            self.preprocessor = Preprocessor().fit(tokens=self.train_tokens,
+                                                   lemmas=self.train_lemmas,
+                                                   pos=self.train_pos,
+                                                   morph=self.train_morph,
+                                                   include_lemma=self.include_lemma,
+                                                   include_morph=self.include_morph,
+                                                   max_token_len=self.max_token_len,
+                                                   focus_repr=self.focus_repr,
+                                                   focus_input=self.focus_input,
+                                                   sparse_targets=self.sparse_targets,
+                                                   min_lem_cnt=self.min_lem_cnt,
+                                                   )
+            self.pretrainer = Pretrainer(nb_left_tokens=self.nb_left_tokens,
+                                         nb_right_tokens=self.nb_right_tokens,
+                                         size=self.nb_embedding_dims,
+                                         minimum_count=self.min_token_freq_emb)
+            self.pretrainer.fit(tokens=self.train_tokens, plot=self.plot_pretraining)
+            if cache:
+                cache.save(fit_key, {'preprocessor': self.preprocessor,
+                                     'pretrainer': self.pretrainer})
 
-        if self.include_lemma:
-            self.train_X_lemma = train_transformed['X_lemma']
-            if self.include_dev:
-                self.dev_X_lemma = dev_transformed['X_lemma']
-            if self.include_test:
-                self.test_X_lemma = test_transformed['X_lemma']
+        self.train_stream = train_stream
 
-        if self.include_pos:
-            self.train_X_pos = train_transformed['X_pos']
-            if self.include_dev:
-                self.dev_X_pos = dev_transformed['X_pos']
-            if self.include_test:
-                self.test_X_pos = test_transformed['X_pos']
-
-        if self.include_morph:
-            self.train_X_morph = train_transformed['X_morph']
-            if self.include_dev:
-                self.dev_X_morph = dev_transformed['X_morph']
-            if self.include_test:
-                self.test_X_morph = test_transformed['X_morph']
-
-        self.train_contexts = self.pretrainer.transform(tokens=self.train_tokens)
+        # vectorize the data (except streamed train data):
+        splits = []
+        if not self.train_stream:
+            splits.append('train')
         if self.include_dev:
-            self.dev_contexts = self.pretrainer.transform(tokens=self.dev_tokens)
+            splits.append('dev')
         if self.include_test:
-            self.test_contexts = self.pretrainer.transform(tokens=self.test_tokens)
+            splits.append('test')
+        for split in splits:
+            for name, value in self.vectorize_split(split, cache, fit_key).items():
+                setattr(self, split + '_' + name, value)
         
+        self.setup_train_eval()
+        if self.resumable:
+            self.save_dataset()
+
         print('Building model...')
         nb_tags = None
         try:
@@ -332,8 +617,12 @@ class Tagger():
                              nb_filters = self.nb_filters,
                              filter_length = self.filter_length,
                              focus_repr = self.focus_repr,
+                             focus_input = self.focus_input,
+                             nb_char_embedding_dims = self.nb_char_embedding_dims,
+                             sparse_targets = self.sparse_targets,
                              dropout_level = self.dropout_level,
                              nb_lemmas = nb_lemmas,
+                             bucket_lengths = self.bucket_lengths,
                             )
         self.save()
         self.setup = True
@@ -364,8 +653,7 @@ class Tagger():
         if self.include_context:
             test_in['context_in'] = self.test_contexts
 
-        test_preds = self.model.predict(test_in,
-                                batch_size=self.batch_size)
+        test_preds = self.predict(test_in)
 
         if isinstance(test_preds, np.ndarray):
             test_preds = [test_preds]
@@ -373,12 +661,9 @@ class Tagger():
         if self.include_lemma:
             print('::: Test scores (lemmas) :::')
             
-            pred_lemmas = self.preprocessor.inverse_transform_lemmas(predictions=test_preds[self.lemma_out_idx])
+            pred_lemmas = self.decode_lemmas(test_preds[self.lemma_out_idx])
             if self.postcorrect:
-                for i in range(len(pred_lemmas)):
-                    if pred_lemmas[i] not in self.known_lemmas:
-                        pred_lemmas[i] = min(self.known_lemmas,
-                                        key=lambda x: editdistance.eval(x, pred_lemmas[i]))
+                pred_lemmas = self.postcorrect_lemmas(pred_lemmas)
             score_dict['test_lemma'] = evaluation.single_label_accuracies(gold=self.test_lemmas,
                                                  silver=pred_lemmas,
                                                  test_tokens=self.test_tokens,
@@ -409,22 +694,32 @@ class Tagger():
         return score_dict
 
     def save(self):
+        """
+        Save the whole tagger: the static artifacts and
+        a checkpoint of the weights.
+        """
+        self.save_static()
+        self.save_checkpoint()
+
+    def save_static(self):
+        """
+        Save what does not change during training: the model
+        architecture, the bundle (preprocessor, pretrainer,
+        known lemmas, lemma index and trie) and the config file.
+        """
         # save architecture:
         json_string = self.model.to_json()
         with open(os.sep.join((self.model_dir, 'model_architecture.json')), 'wb') as f:
             f.write(json_string.encode())
-        # save weights:
-        self.model.save_weights(os.sep.join((self.model_dir, 'model_weights.hdf5')), overwrite=True)
-        # save preprocessor:
-        with open(os.sep.join((self.model_dir, 'preprocessor.p')), 'wb') as f:
-            pickle.dump(self.preprocessor, f)
-        # save pretrainer:
-        with open(os.sep.join((self.model_dir, 'pretrainer.p')), 'wb') as f:
-            pickle.dump(self.pretrainer, f)
+        # save preprocessor, pretrainer, known lemmas, lemma
+        # index for post-correction and lemma trie for decoding:
         if self.include_lemma:
-            # save known lemmas:
-            with open(os.sep.join((self.model_dir, 'known_lemmas.p')), 'wb') as f:
-                pickle.dump(self.known_lemmas, f)
+            save_bundle(self.model_dir, self.preprocessor, self.pretrainer,
+                        known_lemmas=self.known_lemmas,
+                        lemma_index=self.known_lemma_index,
+                        lemma_trie=self.get_lemma_trie())
+        else:
+            save_bundle(self.model_dir, self.preprocessor, self.pretrainer)
         # save config file:
         if self.config_path:
             # make sure that we can reproduce parametrization when reloading:
@@ -444,6 +739,9 @@ class Tagger():
                 F.write('nb_filters = '+str(self.nb_filters)+'\n')
                 F.write('filter_length = '+str(self.filter_length)+'\n')
                 F.write('focus_repr = '+str(self.focus_repr)+'\n')
+                F.write('focus_input = '+str(self.focus_input)+'\n')
+                F.write('nb_char_embedding_dims = '+str(self.nb_char_embedding_dims)+'\n')
+                F.write('sparse_targets = '+str(self.sparse_targets)+'\n')
                 F.write('dropout_level = '+str(self.dropout_level)+'\n')
                 F.write('include_token = '+str(self.include_context)+'\n')
                 F.write('include_context = '+str(self.include_context)+'\n')
@@ -457,39 +755,348 @@ class Tagger():
                 F.write('max_token_len = '+str(self.max_token_len)+'\n')
                 F.write('min_token_freq_emb = '+str(self.min_token_freq_emb)+'\n')
                 F.write('min_lem_cnt = '+str(self.min_lem_cnt)+'\n')
-        
-        # plot current embeddings:
+                F.write('lemma_index = '+str(self.lemma_index)+'\n')
+                F.write('correction_cache_size = '+str(self.correction_cache_size)+'\n')
+                F.write('persist_correction_cache = '+str(self.persist_correction_cache)+'\n')
+                F.write('prediction_cache_size = '+str(self.prediction_cache_size)+'\n')
+                F.write('stream_train = '+str(self.stream_train)+'\n')
+                F.write('shuffle_buffer = '+str(self.shuffle_buffer)+'\n')
+                F.write('eval_train = '+str(self.eval_train)+'\n')
+                F.write('eval_train_every = '+str(self.eval_train_every)+'\n')
+                F.write('eval_train_size = '+str(self.eval_train_size)+'\n')
+                F.write('plot_pretraining = '+str(self.plot_pretraining)+'\n')
+                F.write('keep_best_on = '+str(self.keep_best_on)+'\n')
+                F.write('dataset_cache = '+str(self.dataset_cache)+'\n')
+                F.write('resumable = '+str(self.resumable)+'\n')
+                F.write('nb_length_buckets = '+str(self.nb_length_buckets)+'\n')
+                F.write('lemma_decoder = '+str(self.lemma_decoder)+'\n')
+                F.write('beam_width = '+str(self.beam_width)+'\n')
+                F.write('novel_lemma_threshold = '+str(self.novel_lemma_threshold)+'\n')
+
+    def save_checkpoint(self, score_dict=None):
+        """
+        Save what changes during training: the weights, and the
+        optimizer state with the epoch counter (`training_state.p`).
+        Both are written under a temporary name and renamed once
+        complete, so that a crash while saving leaves the previous
+        checkpoint intact. If `keep_best_on` names one of the scores
+        of `epoch()` (e.g. 'dev_lemma_postcorrect'), a copy of the
+        weights of the best epoch so far is kept as well.
+        """
+        weights_path = os.sep.join((self.model_dir, 'model_weights.hdf5'))
+        self.model.save_weights(weights_path + '.tmp', overwrite=True)
+        os.replace(weights_path + '.tmp', weights_path)
+
+        if self.keep_best_on and score_dict is not None:
+            if self.keep_best_on not in score_dict:
+                print('\t- No', self.keep_best_on, 'score to keep the best weights on, use one of:',
+                      ', '.join(sorted(score_dict)))
+            else:
+                score = score_dict[self.keep_best_on]
+                if isinstance(score, tuple):
+                    # (all, known, unknown) accuracies:
+                    score = score[0]
+                if self.best_score is None or score > self.best_score:
+                    print('\t- Keeping weights: best', self.keep_best_on, 'so far:', score)
+                    best_weights_path = os.sep.join((self.model_dir, 'model_weights_best.hdf5'))
+                    shutil.copyfile(weights_path, best_weights_path + '.tmp')
+                    os.replace(best_weights_path + '.tmp', best_weights_path)
+                    self.best_score, self.best_epoch = score, self.curr_nb_epochs
+
+        state = {'curr_nb_epochs': self.curr_nb_epochs,
+                 'lr': float(K.get_value(self.model.optimizer.lr)),
+                 'optimizer_weights': self.model.optimizer.get_weights(),
+                 'scores': score_dict,
+                 'best_score': self.best_score,
+                 'best_epoch': self.best_epoch,
+                 'fit_key': self.fit_key,
+                 'dataset_keys': self.dataset_keys}
+        state_path = os.sep.join((self.model_dir, 'training_state.p'))
+        with open(state_path + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    def plot_embeddings(self, outputfile=None, nb_clusters=8):
+        """
+        Plot the current context embeddings of the most frequent
+        items (t-SNE, coloured by cluster), by default to
+        `embed_after.pdf` in the model directory. This is slow,
+        so it is left to a separate call (e.g. `report.py`)
+        rather than done at each save.
+        """
+        if not self.include_context:
+            raise ValueError('This model has no context embeddings to plot.')
+        from pandora.plotting import plot_embeddings
+
+        if outputfile is None:
+            outputfile = os.sep.join((self.model_dir, 'embed_after.pdf'))
+        layer_dict = dict([(layer.name, layer) for layer in self.model.layers])
+        weights = layer_dict['context_embedding'].get_weights()[0]
+        token_idx = self.pretrainer.token_idx
+        labels = [w for w in self.pretrainer.mfi if w in token_idx]
+        X = np.array([weights[token_idx[w], :] for w in labels], dtype='float32')
+        plot_embeddings(X, labels=labels, outputfile=outputfile,
+                        nb_clusters=nb_clusters)
+
+    def postcorrect_lemmas(self, pred_lemmas):
+        """
+        Replace each predicted lemma which is not a known
+        lemma by its nearest neighbour in the lemma index
+        (see `pandora.postcorrection` for the tie-break).
+        """
+        corrected = []
+        for lemma in pred_lemmas:
+            if lemma in self.known_lemmas:
+                corrected.append(lemma)
+                continue
+            nearest = self.correction_cache.get(lemma)
+            if nearest is None:
+                nearest = self.known_lemma_index.nearest(lemma)
+                self.correction_cache.put(lemma, nearest)
+            corrected.append(nearest)
+        return corrected
+
+    def load_correction_cache(self):
+        """
+        Warm the correction cache with the one saved in the
+        model directory by an earlier run (if any and if
+        `persist_correction_cache` is set).
+        """
+        cache_path = os.sep.join((self.model_dir, 'correction_cache.p'))
+        if self.persist_correction_cache and os.path.isfile(cache_path):
+            print('Loading correction cache...')
+            self.correction_cache = pickle.load(open(cache_path, 'rb'))
+            self.correction_cache.resize(self.correction_cache_size)
+            # only report on the current run:
+            self.correction_cache.hits, self.correction_cache.misses = 0, 0
+        else:
+            self.correction_cache = LRUCache(maxsize=self.correction_cache_size)
+
+    def save_correction_cache(self):
+        if self.persist_correction_cache and self.include_lemma:
+            with open(os.sep.join((self.model_dir, 'correction_cache.p')), 'wb') as f:
+                pickle.dump(self.correction_cache, f)
+
+    def setup_train_eval(self):
+        """
+        Fix the part of the training data on which scores are
+        reported after each epoch: the full set or, with
+        `eval_train_size`, a sample stratified by POS tag (or
+        by lemma), drawn once so that epochs are comparable.
+        """
+        self.train_eval_in = None
+        self.train_eval_gold = {'token': self.train_tokens,
+                                'lemma': self.train_lemmas,
+                                'pos': self.train_pos,
+                                'morph': self.train_morph}
+        if not self.eval_train or not self.eval_train_size or \
+                self.eval_train_size >= len(self.train_tokens):
+            return
+
+        strata = self.train_pos or self.train_lemmas
+        idxs = utils.stratified_sample(strata or [None] * len(self.train_tokens),
+                                       size=self.eval_train_size)
+        for k, v in self.train_eval_gold.items():
+            if v is not None:
+                self.train_eval_gold[k] = [v[i] for i in idxs]
+
+        self.train_eval_in = {}
+        if self.include_token:
+            self.train_eval_in['focus_in'] = self.preprocessor.transform(\
+                            tokens=self.train_eval_gold['token'])['X_focus']
+        if self.include_context:
+            if self.train_stream:
+                # contexts need the neighbouring tokens in the full
+                # set, but only those of the sample are built:
+                self.train_eval_in['context_in'] = self.pretrainer.transform(\
+                                tokens=self.train_tokens, idxs=idxs)
+            else:
+                self.train_eval_in['context_in'] = self.train_contexts[idxs]
+
+    def vectorize(self, data):
+        """
+        Vectorize a dict of annotated instances (as returned
+        by `utils.load_annotated_file()`) into the input and
+        output dicts of the model.
+        """
+        transformed = self.preprocessor.transform(tokens=data['token'],
+                                                  lemmas=data.get('lemma'),
+                                                  pos=data.get('pos'),
+                                                  morph=data.get('morph'))
+        inputs, outputs = {}, {}
+        if self.include_token:
+            inputs['focus_in'] = transformed['X_focus']
         if self.include_context:
-            layer_dict = dict([(layer.name, layer) for layer in self.model.layers])
-            weights = layer_dict['context_embedding'].get_weights()[0]
-            X = np.array([weights[self.pretrainer.train_token_vocab.index(w), :] \
-                    for w in self.pretrainer.mfi \
-                      if w in self.pretrainer.train_token_vocab], dtype='float32')
-            # dimension reduction:
-            tsne = TSNE(n_components=2)
-            coor = tsne.fit_transform(X) # unsparsify
-            plt.clf(); sns.set_style('dark')
-            sns.plt.rcParams['axes.linewidth'] = 0.4
-            fig, ax1 = sns.plt.subplots()  
-            labels = self.pretrainer.mfi
-            # first plot slices:
-            x1, x2 = coor[:,0], coor[:,1]
-            ax1.scatter(x1, x2, 100, edgecolors='none', facecolors='none')
-            # clustering on top (add some colouring):
-            clustering = AgglomerativeClustering(linkage='ward',
-                            affinity='euclidean', n_clusters=8)
-            clustering.fit(coor)
-            # add names:
-            for x, y, name, cluster_label in zip(x1, x2, labels, clustering.labels_):
-                ax1.text(x, y, name, ha='center', va="center",
-                         color=plt.cm.spectral(cluster_label / 10.),
-                         fontdict={'family': 'Arial', 'size': 8})
-            # control aesthetics:
-            ax1.set_xlabel(''); ax1.set_ylabel('')
-            ax1.set_xticklabels([]); ax1.set_xticks([])
-            ax1.set_yticklabels([]); ax1.set_yticks([])
-            sns.plt.savefig(os.sep.join((self.model_dir, 'embed_after.pdf')),
-                            bbox_inches=0)
+            inputs['context_in'] = self.pretrainer.transform(tokens=data['token'])
+        if 'X_lemma' in transformed:
+            outputs['lemma_out'] = transformed['X_lemma']
+        if 'X_pos' in transformed:
+            outputs['pos_out'] = transformed['X_pos']
+        if 'X_morph' in transformed:
+            outputs['morph_out'] = transformed['X_morph']
+        return inputs, outputs
+
+    def decode(self, preds, multilabel_threshold=0.5):
+        """
+        Convert raw model outputs to lists of labels (lemmas
+        are not post-corrected here).
+        """
+        if isinstance(preds, np.ndarray):
+            preds = [preds]
+        decoded = {}
+        if self.include_lemma:
+            decoded['lemma'] = list(self.decode_lemmas(preds[self.lemma_out_idx]))
+        if self.include_pos:
+            decoded['pos'] = list(self.preprocessor.inverse_transform_pos(\
+                                    predictions=preds[self.pos_out_idx]))
+        if self.include_morph:
+            decoded['morph'] = list(self.preprocessor.inverse_transform_morph(\
+                                    predictions=preds[self.morph_out_idx],
+                                    threshold=multilabel_threshold))
+        return decoded
+
+    def decode_lemmas(self, predictions):
+        """
+        Decode the lemma outputs: greedily or, for lemma generators
+        with `lemma_decoder = beam`, by a beam search over the trie
+        of known lemmas (see `pandora.decoding`), which only yields
+        novel lemmas if none is found or if the greedy output has a
+        probability of at least `novel_lemma_threshold`. Since known
+        lemmas are not post-corrected, the lemma index is then only
+        searched for those.
+        """
+        if self.include_lemma == 'generate' and self.lemma_decoder == 'beam':
+            return self.get_lemma_trie().decode(predictions,
+                                                self.preprocessor.lemma_char_idx,
+                                                beam_width=self.beam_width,
+                                                novel_lemma_threshold=self.novel_lemma_threshold)
+        return self.preprocessor.inverse_transform_lemmas(predictions=predictions)
+
+    def get_lemma_trie(self):
+        """
+        Trie of the known lemmas for beam search decoding (None
+        unless lemmas are generated), built once: it is saved
+        in the bundle of the model.
+        """
+        if self.lemma_trie is None and self.include_lemma == 'generate':
+            print('Building lemma trie...')
+            self.lemma_trie = build_lemma_trie(self.known_lemmas, self.preprocessor)
+        return self.lemma_trie
+
+    def predict_stream(self, stream, multilabel_threshold=0.5):
+        """
+        Predict and decode the instances of a stream (see
+        `setup_to_train()`) chunk by chunk, so that the raw
+        predictions are never held for the whole stream.
+        """
+        decoded = {}
+        for data in stream():
+            if not data['token']:
+                continue
+            inputs, _ = self.vectorize({'token': data['token']})
+            preds = self.decode(self.predict(inputs),
+                                multilabel_threshold=multilabel_threshold)
+            for k, v in preds.items():
+                decoded.setdefault(k, []).extend(v)
+        return decoded
+
+    def batch_generator(self, stream, shuffle=True):
+        """
+        Endless generator of (inputs, outputs) training
+        batches. The instances are read and vectorized chunk
+        by chunk from `stream` and shuffled within a buffer of
+        `shuffle_buffer` tokens, so that memory usage depends
+        on the buffer size rather than on the corpus size.
+        With `nb_length_buckets`, the batches of each buffer are
+        bucketed by token length (see `pandora.bucketing`).
+        """
+        while True:
+            buffered, nb_buffered = [], 0
+            for data in stream():
+                if not data['token']:
+                    continue
+                buffered.append(self.vectorize(data))
+                nb_buffered += len(data['token'])
+                if nb_buffered >= self.shuffle_buffer:
+                    batches, buffered = self._split_batches(buffered, shuffle)
+                    nb_buffered = sum(self._nb_rows(b) for b in buffered)
+                    for batch in batches:
+                        yield batch
+            if buffered:
+                batches, _ = self._split_batches(buffered, shuffle, final=True)
+                for batch in batches:
+                    yield batch
+
+    def bucket_generator(self, inputs, outputs):
+        """
+        Endless generator of (inputs, outputs) training batches
+        from in-memory data, in which each batch holds tokens of
+        similar lengths and its focus input is cut to the longest
+        of them (see `pandora.bucketing`).
+        """
+        lengths = bucketing.focus_lengths(inputs['focus_in'])
+        while True:
+            for idxs in bucketing.bucket_batches(lengths, self.batch_size,
+                                                 self.nb_length_buckets):
+                idxs = np.sort(idxs)
+                yield (bucketing.cut_focus(inputs, idxs, lengths),
+                       {k: v[idxs] for k, v in outputs.items()})
+
+    def predict(self, inputs):
+        """
+        Raw model predictions for a dict of inputs, with batches
+        cut to the length of their longest focus token when the
+        model was built with `nb_length_buckets`.
+        """
+        if self.bucket_lengths:
+            return bucketing.predict_bucketed(self.model, inputs,
+                                              batch_size=self.batch_size)
+        return self.model.predict(inputs, batch_size=self.batch_size)
+
+    @property
+    def bucket_lengths(self):
+        return bool(self.nb_length_buckets) and bool(self.include_token)
+
+    def _nb_rows(self, batch):
+        inputs, _ = batch
+        return len(next(iter(inputs.values())))
+
+    def _split_batches(self, buffered, shuffle, final=False):
+        # concatenate the buffered chunks:
+        inputs = {k: np.concatenate([b[0][k] for b in buffered]) \
+                    for k in buffered[0][0]}
+        outputs = {k: np.concatenate([b[1][k] for b in buffered]) \
+                    for k in buffered[0][1]}
+        nb_rows = self._nb_rows((inputs, outputs))
+        if self.bucket_lengths:
+            lengths = bucketing.focus_lengths(inputs['focus_in'])
+            batches = bucketing.bucket_batches(lengths, self.batch_size,
+                                               self.nb_length_buckets, shuffle=shuffle)
+        else:
+            if shuffle:
+                order = np.random.permutation(nb_rows)
+            else:
+                order = np.arange(nb_rows)
+            batches = [order[i : i + self.batch_size] \
+                        for i in range(0, nb_rows, self.batch_size)]
+        # only emit full batches, unless this is the last buffer:
+        rest = []
+        if not final:
+            rest = [idxs for idxs in batches if len(idxs) < self.batch_size]
+            batches = [idxs for idxs in batches if len(idxs) == self.batch_size]
+        if rest:
+            rest = [np.concatenate(rest)]
+
+        def take(idxs, cut=False):
+            if cut:
+                batch_in = bucketing.cut_focus(inputs, idxs, lengths)
+            else:
+                batch_in = {k: v[idxs] for k, v in inputs.items()}
+            return (batch_in, {k: v[idxs] for k, v in outputs.items()})
+
+        # (the rest is buffered again, so its inputs are not cut):
+        return [take(idxs, cut=self.bucket_lengths) for idxs in batches], \
+                    [take(idxs) for idxs in rest]
 
     def epoch(self, autosave=True):
         if not self.setup:
@@ -507,30 +1114,51 @@ class Tagger():
                 K.set_value(self.model.optimizer.lr, new_lr)
                 print('\t- Lowering learning rate > was:', old_lr, ', now:', new_lr)
 
-        # get inputs and outputs straight:
-        train_in, train_out = {}, {}
-        if self.include_token:
-            train_in['focus_in'] = self.train_X_focus
-        if self.include_context:
-            train_in['context_in'] = self.train_contexts
+        if self.train_stream:
+            # vectorize the training data batch by batch, with
+            # a new pass over the stream for each epoch:
+            self.model.fit_generator(self.batch_generator(self.train_stream),
+                  samples_per_epoch = len(self.train_tokens),
+                  nb_epoch = 1)
+        else:
+            # get inputs and outputs straight:
+            train_in, train_out = {}, {}
+            if self.include_token:
+                train_in['focus_in'] = self.train_X_focus
+            if self.include_context:
+                train_in['context_in'] = self.train_contexts
 
-        if self.include_lemma:
-            train_out['lemma_out'] = self.train_X_lemma
-        if self.include_pos:
-            train_out['pos_out'] = self.train_X_pos
-        if self.include_morph:
-            train_out['morph_out'] = self.train_X_morph
-        
-        self.model.fit(train_in, train_out,
-              nb_epoch = 1,
-              shuffle = True,
-              batch_size = self.batch_size)
+            if self.include_lemma:
+                train_out['lemma_out'] = self.train_X_lemma
+            if self.include_pos:
+                train_out['pos_out'] = self.train_X_pos
+            if self.include_morph:
+                train_out['morph_out'] = self.train_X_morph
+            
+            if self.bucket_lengths:
+                # batches of tokens of similar lengths:
+                self.model.fit_generator(self.bucket_generator(train_in, train_out),
+                      samples_per_epoch = len(self.train_tokens),
+                      nb_epoch = 1)
+            else:
+                self.model.fit(train_in, train_out,
+                      nb_epoch = 1,
+                      shuffle = True,
+                      batch_size = self.batch_size)
+        # cached predictions are outdated now:
+        self.prediction_cache.clear()
 
-        # get train preds:
-        train_preds = self.model.predict(train_in,
-                                batch_size=self.batch_size)
-        if isinstance(train_preds, np.ndarray):
-            train_preds = [train_preds]
+        # get train preds (on a sample, or not at every epoch):
+        eval_train = self.eval_train and \
+                        self.curr_nb_epochs % max(self.eval_train_every, 1) == 0
+        if eval_train:
+            if self.train_eval_in is not None:
+                train_preds = self.decode(self.predict(self.train_eval_in))
+            elif self.train_stream:
+                train_preds = self.predict_stream(self.train_stream)
+            else:
+                train_preds = self.decode(self.predict(train_in))
+            train_gold = self.train_eval_gold
 
         if self.include_dev:
             dev_in = {}
@@ -539,22 +1167,23 @@ class Tagger():
             if self.include_context:
                 dev_in['context_in'] = self.dev_contexts
 
-            dev_preds = self.model.predict(dev_in,
-                                    batch_size=self.batch_size)
+            dev_preds = self.predict(dev_in)
             if isinstance(dev_preds, np.ndarray):
                 dev_preds = [dev_preds]
 
         score_dict = {}
+        if eval_train:
+            score_dict['train_eval_size'] = len(train_gold['token'])
         if self.include_lemma:
-            print('::: Train scores (lemmas) :::')
-            pred_lemmas = self.preprocessor.inverse_transform_lemmas(predictions=train_preds[self.lemma_out_idx])
-            score_dict['train_lemma'] = evaluation.single_label_accuracies(gold=self.train_lemmas,
-                                                 silver=pred_lemmas,
-                                                 test_tokens=self.train_tokens,
-                                                 known_tokens=self.preprocessor.known_tokens)
+            if eval_train:
+                print('::: Train scores (lemmas) :::')
+                score_dict['train_lemma'] = evaluation.single_label_accuracies(gold=train_gold['lemma'],
+                                                     silver=train_preds['lemma'],
+                                                     test_tokens=train_gold['token'],
+                                                     known_tokens=self.preprocessor.known_tokens)
             if self.include_dev:
                 print('::: Dev scores (lemmas) :::')
-                pred_lemmas = self.preprocessor.inverse_transform_lemmas(predictions=dev_preds[self.lemma_out_idx])
+                pred_lemmas = self.decode_lemmas(dev_preds[self.lemma_out_idx])
                 score_dict['dev_lemma'] = evaluation.single_label_accuracies(gold=self.dev_lemmas,
                                                      silver=pred_lemmas,
                                                      test_tokens=self.dev_tokens,
@@ -562,22 +1191,19 @@ class Tagger():
                 
                 if self.postcorrect:
                     print('::: Dev scores (lemmas) -> postcorrected :::')
-                    for i in range(len(pred_lemmas)):
-                        if pred_lemmas[i] not in self.known_lemmas:
-                            pred_lemmas[i] = min(self.known_lemmas,
-                                            key=lambda x: editdistance.eval(x, pred_lemmas[i]))
+                    pred_lemmas = self.postcorrect_lemmas(pred_lemmas)
                     score_dict['dev_lemma_postcorrect'] = evaluation.single_label_accuracies(gold=self.dev_lemmas,
                                                      silver=pred_lemmas,
                                                      test_tokens=self.dev_tokens,
                                                      known_tokens=self.preprocessor.known_tokens)
 
         if self.include_pos:
-            print('::: Train scores (pos) :::')
-            pred_pos = self.preprocessor.inverse_transform_pos(predictions=train_preds[self.pos_out_idx])
-            score_dict['train_pos'] = evaluation.single_label_accuracies(gold=self.train_pos,
-                                                 silver=pred_pos,
-                                                 test_tokens=self.train_tokens,
-                                                 known_tokens=self.preprocessor.known_tokens)
+            if eval_train:
+                print('::: Train scores (pos) :::')
+                score_dict['train_pos'] = evaluation.single_label_accuracies(gold=train_gold['pos'],
+                                                     silver=train_preds['pos'],
+                                                     test_tokens=train_gold['token'],
+                                                     known_tokens=self.preprocessor.known_tokens)
             if self.include_dev:
                 print('::: Dev scores (pos) :::')
                 pred_pos = self.preprocessor.inverse_transform_pos(predictions=dev_preds[self.pos_out_idx])
@@ -587,19 +1213,18 @@ class Tagger():
                                                      known_tokens=self.preprocessor.known_tokens)
         
         if self.include_morph:
-            print('::: Train scores (morph) :::')
-            pred_morph = self.preprocessor.inverse_transform_morph(predictions=train_preds[self.morph_out_idx])
-            if self.include_morph == 'label':
-                score_dict['train_morph'] = evaluation.single_label_accuracies(gold=self.train_morph,
-                                                 silver=pred_morph,
-                                                 test_tokens=self.train_tokens,
-                                                 known_tokens=self.preprocessor.known_tokens)
-            elif self.include_morph == 'multilabel':
-                score_dict['train_morph'] = evaluation.multilabel_accuracies(gold=self.train_morph,
-                                                 silver=pred_morph,
-                                                 test_tokens=self.train_tokens,
-                                                 known_tokens=self.preprocessor.known_tokens)
-
+            if eval_train:
+                print('::: Train scores (morph) :::')
+                if self.include_morph == 'label':
+                    score_dict['train_morph'] = evaluation.single_label_accuracies(gold=train_gold['morph'],
+                                                     silver=train_preds['morph'],
+                                                     test_tokens=train_gold['token'],
+                                                     known_tokens=self.preprocessor.known_tokens)
+                elif self.include_morph == 'multilabel':
+                    score_dict['train_morph'] = evaluation.multilabel_accuracies(gold=train_gold['morph'],
+                                                     silver=train_preds['morph'],
+                                                     test_tokens=train_gold['token'],
+                                                     known_tokens=self.preprocessor.known_tokens)
 
             if self.include_dev:
                 print('::: Dev scores (morph) :::')
@@ -616,53 +1241,284 @@ class Tagger():
                                                      known_tokens=self.preprocessor.known_tokens)
 
         if autosave:
-            self.save()
+            self.save_checkpoint(score_dict)
         
         return score_dict
 
     def annotate(self, tokens):
-        X_focus = self.preprocessor.transform(tokens=tokens)['X_focus']
-        X_context = self.pretrainer.transform(tokens=tokens)
-        
-        # get predictions:
-        new_in = {}
+        return self.annotate_batch([tokens])[0]
+
+    def annotate_batch(self, token_lists):
+        """
+        Annotate several token sequences with a single call
+        to the model. Each sequence keeps its own contexts
+        (they are vectorized separately); one annotation dict
+        is returned per sequence.
+        """
+        vectorized = [self.vectorize({'token': tokens})[0] \
+                        for tokens in token_lists if len(tokens)]
+        decoded = {}
+        if vectorized:
+            new_in = {k: np.concatenate([v[k] for v in vectorized]) \
+                        for k in vectorized[0]}
+            # get predictions:
+            decoded = self.decode_annotations(self.predict_decoded(new_in,
+                                    [t for tokens in token_lists for t in tokens]))
+
+        # scatter the predictions back over the sequences:
+        annotations, offset = [], 0
+        for tokens in token_lists:
+            end = offset + len(tokens)
+            annotations.append(self.annotation_dict(tokens,
+                    {k: v[offset:end] for k, v in decoded.items()}))
+            offset = end
+
+        return annotations
+
+    def annotate_iter(self, token_stream, chunk_size=10000, queue_size=2):
+        """
+        Annotate an iterable of tokens, yielding one annotation
+        dict per chunk of `chunk_size` tokens. The work is
+        pipelined over three stages connected by bounded queues:
+        a thread reads and vectorizes chunks, the calling thread
+        runs the model (see `predict_decoded()`), and another
+        thread post-corrects, so that these overlap across chunks. Contexts
+        are taken across chunk boundaries, so that the output is
+        identical to that of `annotate()` on the whole stream.
+        """
+        stop = threading.Event()
+        vectorized = queue.Queue(maxsize=queue_size)
+        predicted = queue.Queue(maxsize=queue_size)
+        annotated = queue.Queue()
+
+        def vectorize_stage():
+            try:
+                for left, chunk, right in self._context_chunks(token_stream, chunk_size):
+                    inputs = self._vectorize_chunk(left, chunk, right)
+                    if not _put(vectorized, (chunk, inputs), stop):
+                        return
+                _put(vectorized, _END, stop)
+            except Exception as e:
+                _put(vectorized, _Failure(e), stop)
+
+        def decode_stage():
+            while not stop.is_set():
+                try:
+                    item = predicted.get(timeout=.1)
+                except queue.Empty:
+                    continue
+                if item is _END:
+                    annotated.put(item)
+                    return
+                chunk, decoded = item
+                try:
+                    annotated.put(self.annotation_dict(chunk,
+                                    self.decode_annotations(decoded)))
+                except Exception as e:
+                    annotated.put(_Failure(e))
+                    # unblock the other stages:
+                    stop.set()
+                    return
+
+        def collect(block):
+            # yield annotations which are ready (or all of them):
+            while True:
+                try:
+                    item = annotated.get(block=block)
+                except queue.Empty:
+                    return
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+
+        for stage in (vectorize_stage, decode_stage):
+            thread = threading.Thread(target=stage)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                item = _get(vectorized, stop)
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                chunk, inputs = item
+                if not _put(predicted, (chunk, self.predict_decoded(inputs, chunk)), stop):
+                    # the decode stage failed:
+                    break
+                for annotation in collect(block=False):
+                    yield annotation
+            _put(predicted, _END, stop)
+            # raises the failure of the decode stage, if any:
+            for annotation in collect(block=True):
+                yield annotation
+        finally:
+            stop.set()
+
+    def annotate_file(self, input_path, output_path, chunk_size=10000,
+                      tokenized_input=False):
+        """
+        Annotate a (possibly very large) text file, streaming it
+        through `annotate_iter()`: the file is read, tokenized and
+        annotated chunk by chunk, and tab-separated annotations
+        are written out as they come, so that memory use depends
+        on `chunk_size` rather than on the size of the file. The
+        output is written under a temporary name and only renamed
+        once complete. Returns the number of tokens annotated.
+        """
+        tokens = utils.iter_unannotated_file(input_path,
+                                             tokenized_input=tokenized_input)
+        nb_tokens = 0
+        tmp_path = output_path + '.tmp'
+        with codecs.open(tmp_path, 'w', 'utf8') as f:
+            for annotations in self.annotate_iter(tokens, chunk_size=chunk_size):
+                keys = list(annotations.keys())
+                for x in zip(*tuple([annotations[k] for k in keys])):
+                    f.write('\t'.join(list(x)) + '\n')
+                nb_tokens += len(annotations['tokens'])
+        os.replace(tmp_path, output_path)
+        return nb_tokens
+
+    def _context_chunks(self, token_stream, chunk_size):
+        """
+        Cut a token stream into chunks, each returned with (at
+        most) `nb_left_tokens` preceding and `nb_right_tokens`
+        following tokens, to vectorize contexts correctly at
+        chunk boundaries.
+        """
+        stream = iter(token_stream)
+        buffer, start = [], 0
+        while True:
+            # read ahead up to the right context of the next chunk:
+            nb_missing = start + chunk_size + self.nb_right_tokens - len(buffer)
+            if nb_missing > 0:
+                buffer.extend(islice(stream, nb_missing))
+            chunk = buffer[start : start + chunk_size]
+            if not chunk:
+                return
+            yield (buffer[max(start - self.nb_left_tokens, 0) : start],
+                   chunk,
+                   buffer[start + len(chunk) : start + len(chunk) + self.nb_right_tokens])
+            start += len(chunk)
+            # only keep what is needed as left context:
+            drop = max(start - self.nb_left_tokens, 0)
+            buffer, start = buffer[drop:], start - drop
+
+    def _vectorize_chunk(self, left, chunk, right):
+        inputs = {}
         if self.include_token:
-            new_in['focus_in'] = X_focus
+            inputs['focus_in'] = self.preprocessor.transform(tokens=chunk)['X_focus']
         if self.include_context:
-            new_in['context_in'] = X_context
-        preds = self.model.predict(new_in)
+            contexts = self.pretrainer.transform(tokens=list(left) + list(chunk) + list(right))
+            inputs['context_in'] = contexts[len(left) : len(left) + len(chunk)]
+        return inputs
 
-        if isinstance(preds, np.ndarray):
-            preds = [preds]
-        
+    def predict_decoded(self, inputs, tokens):
+        """
+        Predict and decode (see `decode()`) the labels of `tokens`
+        from their vectorized `inputs`, running the model only
+        once per distinct input: per lowercased token for models
+        without context, per lowercased token and context token
+        ids otherwise (the inputs only depend on those). Decoded
+        labels are kept across calls in an LRU cache of
+        `prediction_cache_size` entries, which is cleared when the
+        weights change.
+        """
+        tokens = as_column(tokens).lower()
+        key_cols = []
+        if self.include_token:
+            key_cols.append(tokens.ids[:, np.newaxis])
+        if self.include_context:
+            key_cols.append(inputs['context_in'])
+        distinct, first, inverse = np.unique(np.hstack(key_cols), axis=0,
+                                             return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        if self.include_token:
+            keys = [(tokens.vocab[row[0]],) + tuple(row[1:]) for row in distinct.tolist()]
+        else:
+            keys = [tuple(row) for row in distinct.tolist()]
+
+        names = [name for name, included in (('lemma', self.include_lemma),
+                                             ('pos', self.include_pos),
+                                             ('morph', self.include_morph)) if included]
+        labels = [self.prediction_cache.get(key) for key in keys]
+        missing = [i for i, label in enumerate(labels) if label is None]
+        if missing:
+            rows = first[missing]
+            decoded = self.decode(self.predict({k: v[rows] for k, v in inputs.items()}))
+            for j, i in enumerate(missing):
+                labels[i] = tuple(decoded[name][j] for name in names)
+                self.prediction_cache.put(keys[i], labels[i])
+
+        self.nb_annotated_tokens += len(tokens)
+        self.nb_predicted_tokens += len(missing)
+        return {name: [labels[i][j] for i in inverse.tolist()] \
+                    for j, name in enumerate(names)}
+
+    def prediction_stats(self):
+        """
+        Statistics of the prediction cache, with the number of
+        tokens annotated and of those actually run through the model.
+        """
+        stats = self.prediction_cache.stats()
+        stats['tokens'] = self.nb_annotated_tokens
+        stats['predicted'] = self.nb_predicted_tokens
+        return stats
+
+    def decode_annotations(self, decoded):
+        """
+        Post-correct the lemmas of decoded predictions, if
+        needed (under the 'postcorrect_lemma' key).
+        """
+        if self.include_lemma and self.postcorrect:
+            decoded['postcorrect_lemma'] = self.postcorrect_lemmas(decoded['lemma'])
+        return decoded
+
+    def annotation_dict(self, tokens, decoded):
         annotation_dict = {'tokens': tokens}
         if self.include_lemma:
-            pred_lemmas = self.preprocessor.inverse_transform_lemmas(predictions=preds[self.lemma_out_idx])
-            annotation_dict['lemmas'] = pred_lemmas
+            annotation_dict['lemmas'] = decoded.get('lemma', [])
             if self.postcorrect:
-                for i in range(len(pred_lemmas)):
-                    if pred_lemmas[i] not in self.known_lemmas:
-                        pred_lemmas[i] = min(self.known_lemmas,
-                                            key=lambda x: editdistance.eval(x, pred_lemmas[i]))
-                annotation_dict['postcorrect_lemmas'] = pred_lemmas
-
+                annotation_dict['postcorrect_lemmas'] = decoded.get('postcorrect_lemma', [])
         if self.include_pos:
-            pred_pos = self.preprocessor.inverse_transform_pos(predictions=preds[self.pos_out_idx])
-            annotation_dict['pos'] = pred_pos
-        
+            annotation_dict['pos'] = decoded.get('pos', [])
         if self.include_morph:
-            pred_morph = self.preprocessor.inverse_transform_morph(predictions=preds[self.morph_out_idx])
-            annotation_dict['morph'] = pred_morph
-
+            annotation_dict['morph'] = decoded.get('morph', [])
         return annotation_dict
-        
 
-        
 
+# markers passed between the stages of Tagger.annotate_iter():
+_END = object()
 
-                
-    
-        
+class _Failure():
+    def __init__(self, error):
+        self.error = error
 
-        
-        
+def _get(q, stop):
+    """
+    Get an item from a queue, unless the pipeline is stopped
+    in the meantime, in which case `_END` is returned.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=.1)
+        except queue.Empty:
+            pass
+    return _END
+
+
+def _put(q, item, stop):
+    """
+    Put `item` on a bounded queue, unless the pipeline is
+    stopped in the meantime. Returns whether it was put.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=.1)
+            return True
+        except queue.Full:
+            pass
+    return False
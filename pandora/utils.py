@@ -5,11 +5,58 @@ from __future__ import print_function
 
 import os
 import codecs
-import re
+import multiprocessing
+
+import numpy as np
 import configparser as ConfigParser
 
+from pandora.corpus import as_column
+
+def annotated_files(directory='directory', extension='.txt'):
+    """
+    Paths of the annotated files under `directory`, in the
+    order in which they are loaded.
+    """
+    filepaths = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            filepath = os.path.join(root, name)
+            if filepath.endswith(extension):
+                filepaths.append(filepath)
+    return filepaths
+
+def iter_annotated_dir(directory='directory', format='.tab', extension='.txt', nb_instances=None,
+                       include_lemma=True, include_morph=True, include_pos=True,
+                       malformed=None):
+    """
+    Lazily yield the instances of each annotated file under
+    `directory` (one dict of lists per file), in the order
+    used by `load_annotated_dir()`.
+    """
+    for filepath in annotated_files(directory, extension):
+        yield load_annotated_file(filepath=filepath,
+                                  format=format,
+                                  nb_instances=nb_instances,
+                                  include_lemma=include_lemma,
+                                  include_morph=include_morph,
+                                  include_pos=include_pos,
+                                  malformed=malformed)
+
+def _load_annotated_file_in_worker(kwargs):
+    malformed = {}
+    instances = load_annotated_file(malformed=malformed, **kwargs)
+    return instances, malformed
+
 def load_annotated_dir(directory='directory', format='.tab', extension='.txt', nb_instances=None,
-                        include_lemma=True, include_morph=True, include_pos=True):
+                        include_lemma=True, include_morph=True, include_pos=True,
+                        nb_workers=1, malformed=None):
+    """
+    Load all annotated files under `directory` into one dict
+    of lists. With `nb_workers` > 1, files are parsed in that
+    many processes. Malformed lines are skipped and counted
+    per file in `malformed` (if a dict is given); a summary
+    is printed.
+    """
     instances = {'token': []}
     if include_lemma:
         instances['lemma'] = []
@@ -17,31 +64,49 @@ def load_annotated_dir(directory='directory', format='.tab', extension='.txt', n
         instances['pos'] = []
     if include_morph:
         instances['morph'] = []
-    for root, dirs, files in os.walk(directory):
-        for name in files:
-            filepath = os.path.join(root, name)
+    if malformed is None:
+        malformed = {}
+
+    filepaths = annotated_files(directory, extension)
+    file_kwargs = [{'filepath': filepath,
+                    'format': format,
+                    'nb_instances': nb_instances,
+                    'include_lemma': include_lemma,
+                    'include_morph': include_morph,
+                    'include_pos': include_pos} for filepath in filepaths]
+    if nb_workers and nb_workers > 1 and len(filepaths) > 1:
+        pool = multiprocessing.Pool(min(nb_workers, len(filepaths)))
+        try:
+            # (imap keeps the order of the files)
+            loaded = list(pool.imap(_load_annotated_file_in_worker, file_kwargs))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        loaded = [_load_annotated_file_in_worker(kwargs) for kwargs in file_kwargs]
+
+    for insts, file_malformed in loaded:
+        for k in instances:
+            instances[k].extend(insts[k])
+        malformed.update(file_malformed)
 
-            if not filepath.endswith(extension):
-                continue
-            print(filepath)
-            insts = load_annotated_file(filepath=filepath,
-                                        format=format,
-                                        nb_instances=nb_instances,
-                                        include_lemma=include_lemma,
-                                        include_morph=include_morph,
-                                        include_pos=include_pos)
-            instances['token'].extend(insts['token'])
-            if include_lemma:
-                instances['lemma'].extend(insts['lemma'])
-            if include_pos:
-                instances['pos'].extend(insts['pos'])
-            if include_morph:
-                instances['morph'].extend(insts['morph'])
+    print('Loaded', len(instances['token']), 'tokens from', len(filepaths),
+          'files under', directory)
+    if malformed:
+        print('Skipped', sum(malformed.values()), 'malformed lines in',
+              len(malformed), 'files:')
+        for filepath, nb_lines in sorted(malformed.items()):
+            print('\t', filepath, ':', nb_lines)
     return instances
 
 def load_annotated_file(filepath='text.txt', format='tab', nb_instances=None,
                         include_lemma=True, include_morph=True,
-                        include_pos=True):
+                        include_pos=True, malformed=None):
+    """
+    Load the instances of an annotated file. Malformed lines
+    are skipped; their number is stored under `filepath` in
+    the `malformed` dict, if given.
+    """
     instances = {'token': []}
     if include_lemma:
         instances['lemma'] = []
@@ -49,6 +114,7 @@ def load_annotated_file(filepath='text.txt', format='tab', nb_instances=None,
         instances['pos'] = []
     if include_morph:
         instances['morph'] = []
+    nb_malformed = 0
     if format == 'conll':
         for line in codecs.open(filepath, 'r', 'utf8'):
             line = line.strip()
@@ -67,9 +133,9 @@ def load_annotated_file(filepath='text.txt', format='tab', nb_instances=None,
                     if include_morph:
                         instances['morph'].append(morph)
                 except ValueError:
-                    pass
+                    nb_malformed += 1
             if nb_instances:
-                if len(instances) >= nb_instances:
+                if len(instances['token']) >= nb_instances:
                     break
     elif format == 'tab':
         for line in codecs.open(filepath, 'r', 'utf8'):
@@ -93,43 +159,89 @@ def load_annotated_file(filepath='text.txt', format='tab', nb_instances=None,
                         instances['pos'].append(pos)
                     if include_morph:
                         instances['morph'].append(morph)
-                except:
-                    print(filepath, ':', line)
+                except IndexError:
+                    nb_malformed += 1
             if nb_instances:
                 if len(instances['token']) >= nb_instances:
                     break
+    if nb_malformed and malformed is not None:
+        malformed[filepath] = malformed.get(filepath, 0) + nb_malformed
     return instances
 
-def load_unannotated_file(filepath='test.txt', nb_instances=None, tokenized_input=False):
+def tokenize_text(text):
+    from nltk.tokenize import wordpunct_tokenize
+    return wordpunct_tokenize(text)
+
+def iter_unannotated_file(filepath='test.txt', nb_instances=None, tokenized_input=False,
+                          chunk_size=1048576):
+    """
+    Lazily yield the tokens of a text file, reading (about)
+    `chunk_size` characters at a time, so that memory does not
+    grow with the size of the file. Each chunk is cut after its
+    last whitespace, so that no token is split between chunks.
+    """
     if tokenized_input:
-        instances = []
-        for line in codecs.open(filepath, 'r', 'utf8'):
-            line = line.strip()
-            if line:
-                instances.append(line)
-            if nb_instances:
-                nb_instances -= 1
-                if nb_instances <= 0:
-                    break
-        return instances
-    else:
-        from nltk.tokenize import wordpunct_tokenize
-        W = re.compile(r'\s+')
         with codecs.open(filepath, 'r', 'utf8') as f:
-            text = W.sub(f.read(), ' ')
-        tokens = wordpunct_tokenize(text)
-        if nb_instances:
-            return tokens[:nb_instances]
-        else:
-            return tokens
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+                if nb_instances:
+                    nb_instances -= 1
+                    if nb_instances <= 0:
+                        return
+        return
+
+    rest = ''
+    with codecs.open(filepath, 'r', 'utf8') as f:
+        while True:
+            block = f.read(chunk_size)
+            text, rest = rest + block, ''
+            if block:
+                # keep the (possibly incomplete) last token for the next chunk:
+                cut = max(text.rfind(c) for c in ' \n\t\r')
+                text, rest = text[:cut + 1], text[cut + 1:]
+            for token in tokenize_text(text):
+                yield token
+                if nb_instances:
+                    nb_instances -= 1
+                    if nb_instances <= 0:
+                        return
+            if not block:
+                return
+
+def load_unannotated_file(filepath='test.txt', nb_instances=None, tokenized_input=False):
+    return list(iter_unannotated_file(filepath, nb_instances=nb_instances,
+                                      tokenized_input=tokenized_input))
 
 def stats(tokens, lemmas, known):
+    tokens = as_column(tokens)
     print('Nb of tokens:', len(tokens))
-    print('Nb of unique tokens:', len(set(tokens)))
-    cnt = sum([1.0 for k in tokens if k not in known])/len(tokens)
+    print('Nb of unique tokens:', len(tokens.vocab))
+    cnt = float(np.sum(~tokens.isin(known)))/len(tokens)
     cnt *= 100.0
     print('Nb of unseen tokens:', cnt)
-    print('Nb of unique lemmas: ', len(set(lemmas)))
+    print('Nb of unique lemmas: ', len(as_column(lemmas).vocab))
+
+
+def stratified_sample(labels, size, seed=1):
+    """
+    Return the sorted indices of a sample of `size` items,
+    in which each label is represented in proportion to its
+    frequency in `labels` (systematic sampling over items
+    grouped by label, in random order within each group).
+    """
+    nb_items = len(labels)
+    if size >= nb_items:
+        return np.arange(nb_items)
+    rnd = np.random.RandomState(seed)
+    # (ids in order of first occurrence, cf. `pandora.corpus`):
+    ids = as_column(labels).ids
+    perm = rnd.permutation(nb_items)
+    order = perm[np.argsort(ids[perm], kind='mergesort')]
+    step = float(nb_items) / size
+    picks = (rnd.rand() * step + np.arange(size) * step).astype('int64')
+    return np.sort(order[picks])
 
 
 def get_param_dict(p):
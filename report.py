@@ -0,0 +1,30 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+
+from pandora.inference import load_tagger
+
+
+def report(model, output=None, nb_clusters=8):
+    """ Plot the context embeddings of a trained model
+
+    :param model: Path to a model directory
+    :param output: Path of the plot (default: embed_after.pdf in the model directory)
+    :param nb_clusters: Number of clusters used to colour the plot
+    """
+    print('::: started :::')
+    tagger = load_tagger(model)
+    print('Tagger loaded, now plotting...')
+    tagger.plot_embeddings(outputfile=output, nb_clusters=nb_clusters)
+    print('::: ended :::')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reporting interface of Pandora")
+    parser.add_argument("model", help="Path to model")
+    parser.add_argument("--output", help="Path of the embeddings plot")
+    parser.add_argument("--nb_clusters", help="Number of clusters", type=int, default=8)
+    report(**vars(parser.parse_args()))
@@ -4,49 +4,161 @@
 from __future__ import print_function
 
 import pandora.utils
-from pandora.tagger import Tagger
 
 import os
 import codecs
 import re
+import time
 import argparse
+import multiprocessing
 
 tokenize = re.compile("\s")
 
 
-def tag_dir(model, input_dir, output_dir, string=None, **kwargs):
+def cache_stats(tagger):
+    """ Statistics of the prediction and post-correction caches of a tagger
+
+    :param tagger: Tagger used for annotation
+    :return: Dictionary of prediction and correction cache stats (the latter None without post-correction)
+    """
+    stats = {'prediction': tagger.prediction_stats(), 'correction': None}
+    if tagger.include_lemma and tagger.postcorrect:
+        stats['correction'] = tagger.correction_cache.stats()
+    return stats
+
+
+def merge_cache_stats(all_stats):
+    """ Sum the cache statistics of several taggers (e.g. one per worker process)
+
+    :param all_stats: List of dictionaries returned by cache_stats()
+    :return: Dictionary of summed stats, with the hit rates recomputed
+    """
+    merged = {}
+    for cache in ('prediction', 'correction'):
+        stats = [s[cache] for s in all_stats if s[cache] is not None]
+        if not stats:
+            merged[cache] = None
+            continue
+        merged[cache] = {k: sum(s[k] for s in stats) for k in stats[0] if k != 'hit_rate'}
+        lookups = merged[cache]['hits'] + merged[cache]['misses']
+        merged[cache]['hit_rate'] = float(merged[cache]['hits']) / lookups if lookups else 0.0
+    return merged
+
+
+def print_cache_stats(stats):
+    """ Print prediction and post-correction cache statistics
+
+    :param stats: Dictionary returned by cache_stats() or merge_cache_stats()
+    """
+    print('Prediction cache: {hits} hits, {misses} misses ({hit_rate:.2%} hit rate, {size} entries), '
+          'model run on {predicted} of {tokens} tokens'.format(**stats['prediction']))
+    if stats['correction'] is not None:
+        print('Post-correction cache: {hits} hits, {misses} misses '
+              '({hit_rate:.2%} hit rate, {size} entries)'.format(**stats['correction']))
+
+
+def report_caches(tagger):
+    """ Print prediction and post-correction cache statistics and store the latter for later runs
+
+    :param tagger: Tagger used for annotation
+    """
+    stats = cache_stats(tagger)
+    print_cache_stats(stats)
+    if stats['correction'] is not None:
+        tagger.save_correction_cache()
+
+
+def annotate_file(tagger, input_path, output_path):
+    """ Tag a single text file, streaming it through the tagger chunk by chunk
+
+    :param tagger: Loaded tagger
+    :param input_path: Path of the text file
+    :param output_path: Path of the tagged file
+    :return: Number of tokens
+    """
+    return tagger.annotate_file(input_path, output_path)
+
+
+# Tagger of each worker process in tag_dir(workers > 1)
+_worker_tagger = None
+
+
+def load_tagger(model, **kwargs):
+    """ Load a tagger, importing keras and its backend only now (cf. tag_dir(workers > 1))
+
+    :param model: Path to a model file
+    :return: Loaded tagger
+    """
+    from pandora.inference import load_tagger as load
+    return load(model, **kwargs)
+
+
+def _init_worker(model, overwrite):
+    global _worker_tagger
+    _worker_tagger = load_tagger(model, **overwrite)
+
+
+def _annotate_file_in_worker(paths):
+    input_path, output_path = paths
+    nb_tokens = annotate_file(_worker_tagger, input_path, output_path)
+    # the cache stats so far of this worker, which the parent keeps the last of:
+    return input_path, nb_tokens, os.getpid(), cache_stats(_worker_tagger)
+
+
+def tag_dir(model, input_dir, output_dir, string=None, workers=1, **kwargs):
     """ Tag a directory of texts
 
     :param model: Path to a model file
     :param input_dir: Path to a directory containing text files
     :param output_dir: Path to output tagged text files
+    :param workers: Number of processes, each loading the model once
     """
     print('::: started :::')
+    overwrite = {k: v for k, v in kwargs.items() if v is not None}
 
-    tagger = Tagger(load=True, model_dir=model, overwrite=kwargs)
-    print('Tagger loaded, now annotating...')
-
-    orig_path = input_dir
-    new_path = output_dir
+    # largest files first, so that the workers finish at about the same time:
+    filenames = [filename for filename in os.listdir(input_dir) if filename.endswith('.txt')]
+    filenames.sort(key=lambda filename: os.path.getsize(os.path.join(input_dir, filename)), reverse=True)
+    paths = [(os.path.join(input_dir, filename), os.path.join(output_dir, filename)) for filename in filenames]
 
-    for filename in os.listdir(orig_path):
-        if not filename.endswith('.txt'):
-            continue
+    start = time.time()
+    nb_files, nb_tokens = 0, 0
+    if workers and workers > 1:
+        if overwrite.get('persist_correction_cache'):
+            print('Warning: the post-correction cache is loaded by each worker, '
+                  'but not saved when annotating with several workers')
+        print('Loading the tagger in', workers, 'worker processes, then annotating...')
+        try:
+            # fresh processes, which each import and initialize the backend themselves:
+            context = multiprocessing.get_context('spawn')
+        except AttributeError:
+            # Python 2 can only fork (the backend is not imported yet in this process):
+            context = multiprocessing
+        pool = context.Pool(workers, initializer=_init_worker, initargs=(model, overwrite))
+        worker_stats = {}
+        try:
+            for input_path, nb_file_tokens, pid, stats in pool.imap_unordered(_annotate_file_in_worker, paths):
+                nb_files += 1
+                nb_tokens += nb_file_tokens
+                worker_stats[pid] = stats
+                print('\t +', os.path.basename(input_path), '({}/{})'.format(nb_files, len(paths)))
+        finally:
+            pool.close()
+            pool.join()
+        if worker_stats:
+            print_cache_stats(merge_cache_stats(list(worker_stats.values())))
+    else:
+        tagger = load_tagger(model, **overwrite)
+        print('Tagger loaded, now annotating...')
+        for input_path, output_path in paths:
+            print('\t +', os.path.basename(input_path))
+            nb_tokens += annotate_file(tagger, input_path, output_path)
+            nb_files += 1
+        report_caches(tagger)
 
-        print('\t +', filename)
-        unseen_tokens = pandora.utils.load_unannotated_file(
-            orig_path + filename,
-            nb_instances=None,
-            tokenized_input=False
-        )
-
-        annotations = tagger.annotate(unseen_tokens)
-        keys = list(annotations.keys())
-        print("Keys :" + "\t".join(keys))
-        with codecs.open(new_path + filename, 'w', 'utf8') as f:
-            for x in zip(*tuple([annotations[k] for k in keys])):
-                f.write('\t'.join(list(x)))
-    
+    elapsed = max(time.time() - start, 1e-9)
+    print('Annotated {} files ({} tokens) in {:.1f}s: {:.1f} tokens/sec, {:.2f} files/sec'.format(
+        nb_files, nb_tokens, elapsed, nb_tokens / elapsed, nb_files / elapsed))
     print('::: ended :::')
 
 
@@ -59,7 +171,7 @@ def tag_string(model, input_dir, output_dir=None, string=None, **kwargs):
 
     print('::: started :::')
 
-    tagger = Tagger(load=True, model_dir=model, overwrite=kwargs)
+    tagger = load_tagger(model, **kwargs)
 
     print('Tagger loaded, now annotating...')
 
@@ -75,6 +187,30 @@ def tag_string(model, input_dir, output_dir=None, string=None, **kwargs):
     for x in zip(*tuple([annotations[k] for k in keys])):
         print('\t'.join(list(x)))
 
+    report_caches(tagger)
+    print('::: ended :::')
+
+def serve(model, server_args, input_dir=None, output_dir=None, string=None, **kwargs):
+    """ Load a model once and serve annotation requests
+
+    :param model: Path to a model file
+    :param server_args: Dictionary of host, port, socket_path, max_batch_tokens and max_latency (ms)
+    """
+    from pandora.server import serve as serve_tagger
+
+    print('::: started :::')
+
+    tagger = load_tagger(model, **kwargs)
+    print('Tagger loaded, now serving...')
+
+    serve_tagger(tagger,
+                 host=server_args["host"],
+                 port=server_args["port"],
+                 socket_path=server_args["socket_path"],
+                 max_batch_tokens=server_args["max_batch_tokens"],
+                 max_latency=server_args["max_latency"] / 1000.0)
+
+    report_caches(tagger)
     print('::: ended :::')
 
 if __name__ == '__main__':
@@ -94,9 +230,54 @@ if __name__ == '__main__':
         action="store_false",
         default=True
     )
+    parser.add_argument(
+        "--persist-correction-cache",
+        dest="persist_correction_cache",
+        help="Save the post-correction cache in the model directory so that it is reused by later runs",
+        action="store_true",
+        default=None
+    )
+    parser.add_argument(
+        "--lemma-decoder",
+        dest="lemma_decoder", choices=("greedy", "beam"),
+        help="Decode generated lemmas greedily, or by a beam search over the known lemmas"
+    )
+    parser.add_argument(
+        "--beam-width",
+        dest="beam_width", type=int,
+        help="Number of hypotheses kept per token by the beam search"
+    )
+    parser.add_argument(
+        "--novel-lemma-threshold",
+        dest="novel_lemma_threshold", type=float,
+        help="Keep the greedy (possibly unknown) lemma when its probability reaches this threshold"
+    )
+
+    parser.add_argument(
+        "--workers",
+        default=1, type=int,
+        help="Number of processes tagging files in parallel, each loading the model once [Directory Mode]"
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true", default=False,
+        help="Keep the model loaded and serve annotation requests over HTTP [Server Mode]"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host to serve on [Server Mode]")
+    parser.add_argument("--port", default=8080, type=int, help="Port to serve on [Server Mode]")
+    parser.add_argument("--socket", dest="socket_path",
+                        help="Serve on this Unix socket instead of a TCP port [Server Mode]")
+    parser.add_argument("--max-batch-tokens", dest="max_batch_tokens", default=4096, type=int,
+                        help="Maximum number of tokens annotated together [Server Mode]")
+    parser.add_argument("--max-latency", dest="max_latency", default=10, type=float,
+                        help="Maximum time (ms) a request waits for others to be batched with [Server Mode]")
 
-    args = parser.parse_args()
-    if args.string:
-        tag_string(**vars(args))
+    args = vars(parser.parse_args())
+    server_args = {k: args.pop(k) for k in ("host", "port", "socket_path", "max_batch_tokens", "max_latency")}
+    workers = args.pop("workers")
+    if args.pop("serve"):
+        serve(server_args=server_args, **args)
+    elif args["string"]:
+        tag_string(**args)
     else:
-        tag_dir(**vars(args))
+        tag_dir(workers=workers, **args)